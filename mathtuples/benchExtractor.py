@@ -0,0 +1,44 @@
+"""
+    mathtuples
+    Timing of math_pattern against math_spans on adversarial documents
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import time
+from .math_extractor import MathExtractor
+__author__ = 'FWTompa'
+
+# each generator builds a document with n suspicious pieces
+DOCUMENTS = {
+    "unclosed math": lambda n: '<p><math><mi>x</mi></p>\n' * n,
+    "unclosed tags": lambda n: '<math id="m" display="inline"' * n,
+    "long attribute": lambda n: '<math alttext="' + 'x' * (20 * n),
+    "distinct prefix": lambda n: "".join('<a%d:math>' % i for i in range(n)),
+    "well formed": lambda n: '<p>let <math id="m"><mi>x</mi><mo>=</mo><mn>1</mn></math></p>\n' * n,
+}
+
+def timed(function, content):
+    start = time.perf_counter()
+    result = function(content)
+    return (time.perf_counter() - start, result)
+
+def findall_spans(content):
+    return [(content[start:end], QName, formula_id) for (start, end, QName, formula_id) in MathExtractor.math_spans(content)]
+
+def main(sizes=(1000, 2000, 4000)):
+    print("%-16s %8s %10s %10s" % ("document", "n", "pattern", "spans"))
+    for (name, document) in DOCUMENTS.items():
+        for n in sizes:
+            content = document(n)
+            (pattern_time, expected) = timed(MathExtractor.math_pattern.findall, content)
+            (spans_time, found) = timed(findall_spans, content)
+            if found != expected:
+                print("MISMATCH on " + name)
+            print("%-16s %8d %9.3fs %9.3fs" % (name, n, pattern_time, spans_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+    mathtuples
+    Checkpoints from which a long conversion can be resumed
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import json
+import os
+import time
+__author__ = 'FWTompa'
+
+INTERVAL = 60  # seconds between checkpoints
+
+
+class Checkpoint(object):
+    """
+    Record, at most every interval seconds, how far a conversion has got: the byte offset in the input
+    of a document boundary, that document's id, and the size of the output flushed for everything before it
+    """
+
+    def __init__(self, name, infile, interval=INTERVAL):
+        """
+        param name: file to hold the checkpoint (replaced atomically each time)
+        type  name: string
+
+        param infile: name of the input file being converted
+        type  infile: string
+
+        param (interval): seconds between checkpoints
+        type  (interval): float
+        """
+        self.name = name
+        self.infile = infile
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    def save(self, offset, docid, fout):
+        """
+        flush the output to disk and record that offset bytes of input produced it
+
+        param offset: input bytes preceding the document boundary
+        type  offset: int
+
+        param docid: id of the document starting at offset
+        type  docid: string
+
+        param fout: output (of a regular file)
+        type  fout: OutputSink
+        """
+        fout.flush()
+        os.fsync(fout.stream.fileno())
+        state = {"infile": self.infile, "offset": offset, "docid": docid, "output": fout.stream.tell()}
+        with open(self.name + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.name + ".tmp", self.name)
+        self.last = time.monotonic()
+
+    def load(self):
+        """
+        return: the last checkpoint saved for this input (None if there is none)
+        rtype:  dict with keys infile, offset, docid, output
+        """
+        if not os.path.exists(self.name):
+            return None
+        with open(self.name) as f:
+            state = json.load(f)
+        if state.get("infile") != self.infile:
+            raise ValueError("checkpoint " + self.name + " is for " + str(state.get("infile")) + ", not " + self.infile)
+        return state
+
+    def remove(self):
+        if os.path.exists(self.name):
+            os.remove(self.name)
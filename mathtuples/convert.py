@@ -34,15 +34,35 @@ Purpose: Convert MathML to Tangent Tuples
 '''
 
 import argparse
+import copy
+import csv
+import io
+import json
 import logging
+import mmap
 import sys
 import os
 import re
+import shutil
+import stat
+import time
 import traceback
+import xml.etree.ElementTree as ET
+from collections import Counter
 __author__ = 'Dallas Fraser, FWTompa'
 
 from .math_extractor import MathExtractor
 from .mathsymbol import MathSymbol, REP_TAG
+from .latex_slt import LatexToSLT
+from .latex_mml import LatexToMathML, LatexMLPool
+from .exceptions import UnsupportedLatexException
+from .workers import WorkerPool, BATCH_COST, mapped_input, shared_directory
+from .output import OutputSink, BUFFER_SIZE
+from .streams import open_input, open_range, text_input, codec, skip
+from .checkpoint import Checkpoint, INTERVAL
+from .manifest import Manifest
+from .formula_index import FormulaIndex
+from .spans import FormulaSpans
 
 START_TAG = "#(start)#"
 END_TAG = "#(end)#"
@@ -68,9 +88,54 @@ ENCODING = "utf-8"
 NAMESPACE = r"(?:[^>=\s:]*:)?"
 MATH_OPENED = re.compile(r"<"+NAMESPACE+r"[Mm]ath[ >]")
 MATH_CLOSED = re.compile(r"</"+NAMESPACE+r"[Mm]ath>")
+MATH_OPENED_BYTES = re.compile(rb"<("+NAMESPACE.encode()+rb"[Mm]ath)[ >]")
 
 PgmMatch = re.compile(r'^.*/([^/]*.py)"(.*)')
 
+MAX_MATH_BYTES = 4000000  # an unterminated math expression is abandoned after this many bytes
+MAX_MATH_LINES = 20000    # or this many lines
+
+# trivial formulas (a single token, perhaps in an mrow, or one token scripted by another)
+# are looked up in TRIVIAL_TUPLES instead of being parsed, once their tuples have been computed
+DEGRADATIONS = ["locations", "synonyms", "duplicates"]  # dropped in this order from a formula past its limits
+STAGES = ["pairs", "terminals", "duplicates", "opt"]  # computed in this order (of value) under a deadline
+
+MAX_TRIVIAL_LENGTH = 1000  # enough for a single symbol with LaTeXML's ids and annotations
+MAX_TRIVIAL = 100000  # table entries
+TRIVIAL_MATH = re.compile(r"\s*<math(\s[^<>]*)?>(.*)</math>\s*\Z", re.DOTALL)
+TRIVIAL_TAG = re.compile(r"<([\w-]+)(\s[^<>]*?)?\s*(/?)>")
+# attributes that can change a formula's tuples (ids, xrefs, classes, alttext, and styles cannot)
+TRIVIAL_KEPT = re.compile(r"""\s(xmlns|encoding|name|cd|src|open|close|separators|notation|closure)\s*=\s*("[^"]*"|'[^']*')""")
+TRIVIAL_BODY = re.compile(r"(?P<semantics><semantics>)?(?P<mrow><mrow>)?"
+                          r"(?:<(?P<token>mi|mn|mo|mtext)>[^<&]*</(?P=token)>"
+                          r"|<(?P<script>msub|msup)><(?P<base>mi|mn|mo|mtext)>[^<&]*</(?P=base)>"
+                          r"<(?P<sub>mi|mn|mo|mtext)>[^<&]*</(?P=sub)></(?P=script)>)(?(mrow)</mrow>)"
+                          r"(?(semantics)(?:<annotation-xml encoding=\"MathML-Content\">[^&]*?</annotation-xml>)?"
+                          r"(?:<annotation encoding=\"application/x-tex\">[^<&]*</annotation>)?</semantics>)")
+TRIVIAL_TUPLES = {}
+
+def trivial_math(mathml):
+    """Returns a key identifying a trivial formula's shape and symbols, or None if it is not trivial
+       (the key is the formula without the attributes and spacing that cannot change its tuples,
+       so that it still holds any namespace and annotations)
+    """
+    if len(mathml) > MAX_TRIVIAL_LENGTH:
+        return None
+    m = TRIVIAL_MATH.match(mathml)
+    if not m:
+        return None
+    attrs = trivial_attributes(m.group(1))
+    if "encoding" in attrs:
+        return None
+    body = TRIVIAL_TAG.sub(lambda tag: "<" + tag.group(1) + trivial_attributes(tag.group(2)) + tag.group(3) + ">",
+                           re.sub(r">\s+<", "><", m.group(2).strip()))
+    return "<math" + attrs + ">" + body + "</math>" if TRIVIAL_BODY.fullmatch(body) else None
+
+def trivial_attributes(attrs):
+    """Returns the attributes, from a tag's attributes, that are kept in a trivial formula's key
+    """
+    return "".join(" " + name + "=" + value for (name, value) in TRIVIAL_KEPT.findall(attrs or ""))
+
 def parse_file(docid="",
                context=False,
                slt=True,
@@ -81,67 +146,688 @@ def parse_file(docid="",
                window_size=1,
                loc_info={},
                anchors=[],
-               include_latex=False):
+               include_latex=False,
+               limits={},
+               max_math_bytes=MAX_MATH_BYTES,
+               max_math_lines=MAX_MATH_LINES,
+               fin=None,
+               fout=None,
+               checkpoint=None,
+               offset=0,
+               only_docids=None,
+               exclude_docids=None,
+               index=None,
+               spans=None):
     """Parses a file and outputs to a file with math tuples
+       (a math expression that is still open after max_math_bytes or max_math_lines, 0 => unlimited,
+       is reported as an error and scanning resumes after it)
+       (input is read from fin, a binary stream, else stdin; output goes to fout, an OutputSink, else to stdout)
+       (if checkpoint, a Checkpoint, it is saved periodically at the start of a document, counting the input bytes
+       from offset, i.e., the position in the input file from which fin is read)
+       (documents not selected by only_docids and exclude_docids, sets of docids, are skipped without looking for math)
+       (if index, a FormulaIndex, the byte offsets of the documents and math expressions are recorded there,
+       counting from offset as for checkpoint)
+       (if spans, a FormulaSpans, the spans of the math expressions in the input and of their tuples in the output are
+       recorded there, relative to the start of each document)
     """
     idRE = re.compile("\Z(.)") # an impossible pattern to match
     if docid != "":
         idRE = re.compile(docid + r"([^ <>]*)")
-    # with (sys.stdin if (infile is None) else open(infile, 'r', encoding=ENCODING)) as fin:
-    with sys.stdin as fin:
-        # with (sys.stdout if (outfile is None) else open(outfile, "w+", encoding=ENCODING)) as fout:
-        with sys.stdout as fout:
+    content_offset = offset  # of the first line in content
+    chars = 0  # characters read, if spans are recorded
+    content_chars = 0
+    with (sys.stdin if (fin is None) else text_input(fin)) as fin:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
             inMath = False;  # start outside all math expressions
             content = []
+            pending = 0  # bytes in content
             mathID = ""
             lineNum = 0
+            skipping = not selected_document(mathID, only_docids, exclude_docids)
+            if index and not skipping:
+                index.add_document(mathID, offset)
+            if spans:
+                spans.start_document(chars, offset, fout)
             for line in fin:  # find a line end outside math expressions
                 lineNum += 1
                 newID = idRE.search(line)
                 if newID:
+                    if checkpoint and not inMath and checkpoint.due():
+                        checkpoint.save(offset, newID.group(1), fout)
+                    skipping = not selected_document(newID.group(1), only_docids, exclude_docids)
+                    if skipping and inMath:  # abandoned at the end of the document holding it
+                        report_unterminated(mathID, lineNum - 1, pending, len(content), fout)
+                        content = []
+                        pending = 0
+                        inMath = False
                     mathID = newID.group(1)
                     lineNum = 0
+                    if index:
+                        index.end_document(offset)
+                        if not skipping:
+                            index.add_document(mathID, offset)
+                    if spans:
+                        spans.start_document(chars, offset, fout)
+                line_offset = offset
+                line_chars = chars
+                if checkpoint or index or spans:
+                    offset += len(line) if line.isascii() else len(line.encode(ENCODING, "surrogateescape"))
+                    chars += len(line)
+                if skipping:
+                    continue
                 frags = MATH_CLOSED.split(line)
                 if inMath or MATH_OPENED.search(frags[-1]): 
+                    if not content:
+                        content_offset = line_offset
+                        content_chars = line_chars
                     content.append(line)
+                    pending += len(line.encode(ENCODING, "surrogateescape"))
                     inMath = True
+                    if (max_math_bytes > 0 and pending > max_math_bytes) or (max_math_lines > 0 and len(content) > max_math_lines):
+                        report_unterminated(mathID, lineNum, pending, len(content), fout)
+                        content = []
+                        pending = 0
+                        inMath = False
+                        continue
                 if MATH_CLOSED.search(line) and not MATH_OPENED.search(frags[-1]): 
                     if inMath:
                         line = "".join(content)
+                        line_offset = content_offset
+                        line_chars = content_chars
                         content = []
+                        pending = 0
                         inMath = False
                     try:
-                        tokens = MathExtractor.math_tokens(line,in_context=context)  # do not precede formula with its formula id
-                        # returns [context0,math1,context1,math2,...,mathn,contextn]
-                        for token in tokens:
-                            if token.startswith("<math"):
-                                ex = convert_math_expression(mathID,lineNum,token,
+                        write_math_tokens(line, mathID, lineNum, fout,
+                                          index=index, offset=line_offset,
+                                          spans=spans, chars=line_chars,
+                                          context=context,
+                                          slt=slt, opt=opt,
+                                          synonyms=synonyms,
+                                          dups=dups,
+                                          wild_dups=wild_dups,
+                                          window_size=window_size,
+                                          loc_info=loc_info,
+                                          anchors=anchors,
+                                          include_latex=include_latex,
+                                          limits=limits)
+                    except Exception as err:
+                        report_error(mathID, lineNum, fout)
+                elif context and not inMath: 
+                    fout.write(line)
+            if inMath:
+                report_unterminated(mathID, lineNum, pending, len(content), fout)
+    if index:
+        index.finish(offset)
+
+def selected_document(mathID, only_docids=None, exclude_docids=None):
+    """Returns whether a document is to be converted, given the sets of docids to convert (None => all) and to skip
+    """
+    return (only_docids is None or mathID in only_docids) and not (exclude_docids and mathID in exclude_docids)
+
+def read_docids(name):
+    """Returns the set of docids listed, one per line, in the named (possibly compressed) file
+    """
+    with text_input(open_input(name)) as fin:
+        return set(line.strip() for line in fin if line.strip())
+
+def report_unterminated(mathID, lineNum, size, lines, fout):
+    """Reports a math expression that was abandoned because it was never closed
+    """
+    print("Unterminated math expression in data file or query "+ mathID +", line "+ str(lineNum) +
+          ": abandoned after " + str(size) + " bytes on " + str(lines) + " lines", file=sys.stderr)
+    fout.write("#(error)# ")
+
+def parse_documents(manifest,
+                    docid="",
+                    fin=None,
+                    fout=None,
+                    only_docids=None,
+                    exclude_docids=None,
+                    **options):
+    """Parses a file of documents, each starting on the line holding its docid, and outputs math tuples like parse_file,
+       but converts only the documents whose content is new or changed since it was recorded in manifest, a Manifest;
+       the output stored there is reused for the others
+       (documents not selected by only_docids and exclude_docids are skipped and kept in the manifest)
+       (input is read from fin, a binary stream, else stdin; output goes to fout, an OutputSink, else to stdout)
+    """
+    with (fin or sys.stdin.buffer) as fin:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
+            seen = {}
+            for (mathID, content) in split_documents(fin, docid):
+                if not selected_document(mathID, only_docids, exclude_docids):
+                    continue
+                seen[mathID] = seen.get(mathID, 0) + 1
+                if seen[mathID] > 1:
+                    mathID += "#" + str(seen[mathID])  # a repeated docid gets a suffix to be unique in the manifest
+                digest = Manifest.digest(content)
+                output = manifest.lookup(mathID, digest)
+                if output is None:
+                    converted = io.BytesIO()
+                    parse_file(docid=docid, fin=io.BytesIO(content), fout=OutputSink(converted), **options)
+                    output = converted.getvalue()
+                    manifest.store(mathID, digest, output)
+                fout.write_bytes(output)
+    dropped = manifest.prune() if only_docids is None and exclude_docids is None else 0
+    print("Manifest: %d documents reused, %d converted, %d dropped" % (manifest.reused, manifest.converted, dropped), file=sys.stderr)
+
+def split_documents(fin, docid=""):
+    """Returns (docid, content) for each document in a binary stream, where content includes the line holding the docid
+       (any text before the first docid is a document with docid "")
+    """
+    idRE = re.compile(rb"\Z(.)") # an impossible pattern to match
+    if docid != "":
+        idRE = re.compile(docid.encode(ENCODING) + rb"([^ <>]*)")
+    mathID = ""
+    lines = []
+    for line in fin:
+        newID = idRE.search(line)
+        if newID:
+            if lines:
+                yield (mathID, b"".join(lines))
+            mathID = newID.group(1).decode(ENCODING, "surrogateescape")
+            lines = []
+        lines.append(line)
+    if lines:
+        yield (mathID, b"".join(lines))
+
+def parse_mapped_file(docid="",
+                      context=False,
+                      max_math_bytes=MAX_MATH_BYTES,
+                      fin=None,
+                      fout=None,
+                      index=None,
+                      **options):
+    """Parses a file (not a pipe) given as fin, else stdin, and outputs math tuples, like parse_file,
+       but scans the memory-mapped bytes: only math expressions are decoded,
+       and the text between them is copied to the output unchanged if context
+       (a math expression not closed within max_math_bytes, 0 => unlimited, is reported as an error)
+       (if index, a FormulaIndex, the byte offsets of the documents and math expressions are recorded there)
+    """
+    idRE = re.compile(rb"\Z(.)") # an impossible pattern to match
+    if docid != "":
+        idRE = re.compile(docid.encode(ENCODING) + rb"([^ <>]*)")
+    fin = fin or sys.stdin.buffer
+    if os.fstat(fin.fileno()).st_size == 0:
+        return
+    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as data, (fout or OutputSink(sys.stdout.buffer)) as fout:
+        mathID = ""
+        lineNum = 1 # lines since the current document's id
+        pos = 0     # everything before pos has been processed
+        if index:
+            index.add_document(mathID, 0)
+        while True:
+            opened = MATH_OPENED_BYTES.search(data, pos)
+            if not opened:
+                if index:
+                    for newID in idRE.finditer(data, pos):
+                        index.add_document(newID.group(1).decode(ENCODING, "replace"), data.rfind(b"\n", 0, newID.start()) + 1)
+                    index.finish(len(data))
+                if context:
+                    fout.write_bytes(data[pos:])
+                break
+            start = opened.start()
+            close = b"</" + opened.group(1) + b">"
+            limit = start + max_math_bytes if max_math_bytes > 0 else len(data)
+            end = data.find(close, opened.end(), limit)
+            unterminated = (end == -1)
+            end = min(limit, len(data)) if unterminated else end + len(close)
+            between = data[pos:start]
+            newID = None
+            for newID in idRE.finditer(between):
+                if index:
+                    index.add_document(newID.group(1).decode(ENCODING, "replace"), data.rfind(b"\n", 0, pos + newID.start()) + 1)
+            if newID:
+                mathID = newID.group(1).decode(ENCODING, "replace")
+                lineNum = between.count(b"\n", newID.start())
+            else:
+                lineNum += between.count(b"\n")
+            if context:
+                fout.write_bytes(between)
+            expr = data[start:end]
+            if unterminated:
+                report_unterminated(mathID, lineNum, end - start, expr.count(b"\n") + 1, fout)
+                lineNum += expr.count(b"\n")
+                pos = end
+                continue
+            if index:
+                index.add_formula(mathID, start, end - start)
+            try:
+                write_math_tokens(expr.decode(ENCODING), mathID, lineNum, fout,
+                                  context=context, **options)
+            except Exception as err:
+                report_error(mathID, lineNum, fout)
+            lineNum += expr.count(b"\n")
+            pos = end
+
+def write_math_tokens(content, mathID, lineNum, fout,
+                      context=False,
+                      slt=True,
+                      opt=False,
+                      synonyms=False,
+                      dups="",
+                      wild_dups="",
+                      window_size=1,
+                      loc_info={},
+                      anchors=[],
+                      include_latex=False,
+                      limits={},
+                      index=None,
+                      offset=0,
+                      spans=None,
+                      chars=0):
+    """Outputs the math tuples for every math expression in content (with the surrounding text if context)
+       (and records in index, if given, where each math expression lies, content starting at byte offset,
+       and in spans, if given, the spans of each math expression and its tuples, content starting at character chars)
+    """
+    if index:
+        index.add_formulas(mathID, content, offset)
+    if spans:
+        input_spans = iter(spans.input_spans(content, chars, offset))
+    tokens = MathExtractor.iter_math_tokens(content,in_context=context)  # do not precede formula with its formula id
+    # yields context0,math1,context1,math2,...,mathn,contextn
+    for token in tokens:
+        if token.startswith("<math"):
+            ex = convert_math_expression(mathID,lineNum,token,
+                                 slt=slt, opt=opt,
+                                 synonyms=synonyms,
+                                 dups=dups,
+                                 wild_dups=wild_dups,
+                                 window_size=window_size,
+                                 loc_info=loc_info,
+                                 anchors=anchors,
+                                 include_latex=include_latex,
+                                 limits=limits)
+            if spans:
+                output_start = (fout.chars, fout.tell())
+            if ex != "":
+                fout.write(ex if context else ex + "\n") # separate math expression on individual lines
+            if spans:
+                input_span = next(input_spans, None)
+                if input_span:
+                    spans.add(mathID, input_span, output_start, fout)
+        else:
+            fout.write(token)
+
+def parse_records_file(records,
+                       id_attr="Id",
+                       body_attr="Body",
+                       docid="",
+                       context=False,
+                       slt=True,
+                       opt=False,
+                       synonyms=False,
+                       dups="",
+                       wild_dups="",
+                       window_size=1,
+                       loc_info={},
+                       anchors=[],
+                       include_latex=False,
+                       limits={},
+                       fin=None,
+                       fout=None,
+                       only_docids=None,
+                       exclude_docids=None):
+    """Streams an XML file of records (e.g., the rows of Posts.xml), converting the math in each record's body,
+       which is HTML (escaped within the XML); in context, each body is output on a line after docid and its id
+       (records whose ids are not selected by only_docids and exclude_docids are skipped)
+       (input is read from fin, a binary stream, else stdin; output goes to fout, an OutputSink, else to stdout)
+    """
+    with (fin or sys.stdin.buffer) as fin:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
+            try:
+                for (mathID, body) in MathExtractor.records(fin, records, id_attr=id_attr, body_attr=body_attr):
+                    if not selected_document(mathID, only_docids, exclude_docids):
+                        continue
+                    if context and docid != "":
+                        fout.write(docid + mathID + "\n")
+                    try:
+                        write_math_tokens(body, mathID, 0, fout,
+                                          context=context,
+                                          slt=slt, opt=opt,
+                                          synonyms=synonyms,
+                                          dups=dups,
+                                          wild_dups=wild_dups,
+                                          window_size=window_size,
+                                          loc_info=loc_info,
+                                          anchors=anchors,
+                                          include_latex=include_latex,
+                                          limits=limits)
+                    except Exception as err:
+                        report_error(mathID, 0, fout)
+                    if context:
+                        fout.write("\n")
+            except ET.ParseError as err:
+                print("Input is not well-formed XML: " + str(err), file=sys.stderr)
+
+def parse_xml_file(docid="",
+                   slt=True,
+                   opt=False,
+                   synonyms=False,
+                   dups="",
+                   wild_dups="",
+                   window_size=1,
+                   loc_info={},
+                   anchors=[],
+                   include_latex=False,
+                   limits={},
+                   fin=None,
+                   fout=None):
+    """Parses a well-formed XML (incl. XHTML) file in one pass and outputs the math tuples
+       for each math element on its own line
+       (docid is the tag of the element holding each document identifier, e.g., "<DOCNO>")
+       (input is read from fin, a binary stream, else stdin; output goes to fout, an OutputSink, else to stdout)
+    """
+    id_tag = docid.strip("<>") if docid else None
+    with (fin or sys.stdin.buffer) as fin:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
+            try:
+                for (mathID, lineNum, elem) in MathExtractor.math_elements(fin, id_tag=id_tag):
+                    try:
+                        ex = convert_math_expression(mathID,lineNum,elem,
                                                      slt=slt, opt=opt,
                                                      synonyms=synonyms,
                                                      dups=dups,
                                                      wild_dups=wild_dups,
                                                      window_size=window_size,
-
                                                      loc_info=loc_info,
                                                      anchors=anchors,
-                                                     include_latex=include_latex)
-                                if ex != "":
-                                    print(ex, file=fout, end="")
-                                    if not context:
-                                        print(file=fout) # separate math expression on individual lines
-                            else:
-                                print(token, file=fout, end="")
+                                                     include_latex=include_latex,
+                                                     limits=limits)
+                        if ex != "":
+                            fout.write(ex + "\n")
                     except Exception as err:
-                        print("Error in data file or query "+ mathID +", line "+ str(lineNum), file=sys.stderr)
-                        stack = traceback.format_exc().split("\n")
-                        where = ""
-                        pgm = PgmMatch.search(stack[-4])
-                        if pgm:
-                            where = pgm.group(1) + pgm.group(2)
-                        print("    program file",where,stack[-3].strip(),stack[-2].strip(),stack[-1],file=sys.stderr)
-                        print("#(error)# ", file=fout, end="")
-                elif context and not inMath: 
-                    print(line,file=fout,end="")
+                        report_error(mathID, lineNum, fout)
+            except ET.ParseError as err:
+                print("Input is not well-formed XML: " + str(err), file=sys.stderr)
+
+def parse_formula_file(file_format,
+                       id_field="id",
+                       math_field="formula",
+                       line=1,
+                       workers=1,
+                       batch_cost=BATCH_COST,
+                       utilization=False,
+                       max_rss=0,
+                       max_tasks=0,
+                       fin=None,
+                       fout=None,
+                       **options):
+    """Reads a file of formulas, one per TSV row or JSON line, and outputs each formula's id and math tuples
+       on a line, separated by a tab; formulas are MathML or else LaTeX, and are converted by workers processes
+       (a row that cannot be read is reported on stderr and output as "line N<TAB>#(error)#"; how the LaTeX formulas
+       were converted, counted across the workers, is reported at the end as by LatexToSLT.report; with batches,
+       the LaTeX formulas of a batch that need LaTeXML are converted together, by prepare_formulas)
+
+    Parameters:
+        file_format: "tsv" (with a header row unless both fields are column numbers) or "jsonl"
+        id_field: column name or number (TSV) or key (JSONL, using . to select nested keys) of the formula id
+        math_field: similarly, for the formula itself
+        line: number of the first line of fin (e.g., 2 if its header row has been read already)
+        batch_cost: estimated cost (see formula_cost) of the formulas sent to a worker at a time; 0 => fixed-size chunks
+        utilization: if True, report each worker's batches and time busy on stderr
+        max_rss: replace a worker whose resident memory exceeds this many bytes (0 => no limit)
+        max_tasks: replace a worker after this many tasks (batches or chunks of formulas; 0 => no limit)
+        fin: binary stream of the input; None => stdin
+        fout: OutputSink for the output; None => stdout
+        options: as for convert_math_expression
+    """
+    read = read_tsv if file_format == "tsv" else read_jsonl
+    methods = Counter()  # how the LaTeX formulas were converted, in whichever process
+    with (sys.stdin if (fin is None) else text_input(fin)) as fin:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
+            with WorkerPool(convert_formula, options, workers=workers, batch_cost=batch_cost,
+                            cost=formula_cost if batch_cost > 0 else None,
+                            max_rss=max_rss, max_tasks=max_tasks, prepare=prepare_formulas) as pool:
+                for (formula_id, ex, method) in pool.imap(read(fin, id_field, math_field, line)):
+                    fout.write(formula_id + "\t" + ex + "\n")
+                    methods[method] += 1
+                if utilization:
+                    pool.report()
+    LatexToSLT.report(file=sys.stderr, counts=methods)
+
+def read_tsv(fin, id_field, math_field, line=1):
+    """Returns (id, formula) pairs from tab-separated rows, and bad_row for a row without both fields
+       (line is the number of the first line of fin)
+    """
+    csv.field_size_limit(2**31 - 1)  # MathML can be long
+    rows = csv.reader(fin, delimiter="\t")
+    if id_field.isdigit() and math_field.isdigit():
+        id_col, math_col = int(id_field), int(math_field)
+    else:
+        (id_col, math_col) = tsv_columns(next(rows, []), id_field, math_field)
+    for row in rows:
+        if not row:
+            continue
+        try:
+            formula = (row[id_col], row[math_col])
+        except IndexError:
+            formula = bad_row(line - 1 + rows.line_num)
+        yield formula
+
+def tsv_columns(header, id_field, math_field):
+    """Returns the column numbers of the id and formula fields, given the TSV header row
+    """
+    for field in (id_field, math_field):
+        if not (field.isdigit() or field in header):
+            raise ValueError("The TSV header has no column named " + field + " (its columns are " + ", ".join(header) + ")")
+    id_col = int(id_field) if id_field.isdigit() else header.index(id_field)
+    math_col = int(math_field) if math_field.isdigit() else header.index(math_field)
+    return (id_col, math_col)
+
+def tsv_header(fin, id_field, math_field):
+    """Reads the header row from fin, a binary stream, and returns the column numbers of the id and formula fields,
+       as strings to be given to read_tsv for the rows that follow
+    """
+    header = next(csv.reader([fin.readline().decode(ENCODING, "surrogateescape")], delimiter="\t"), [])
+    return tuple(str(col) for col in tsv_columns(header, id_field, math_field))
+
+def read_jsonl(fin, id_field, math_field, line=1):
+    """Returns (id, formula) pairs from JSON objects, one per line, and bad_row for a line that is not such an object
+       (line is the number of the first line of fin)
+    """
+    def select(record, field):
+        for key in field.split("."):
+            record = record[key]
+        return str(record)
+    for (lineNum, text) in enumerate(fin, line):
+        if text.strip():
+            try:
+                record = json.loads(text)
+                formula = (select(record, id_field), select(record, math_field))
+            except (ValueError, KeyError, TypeError):
+                formula = bad_row(lineNum)
+            yield formula
+
+def bad_row(lineNum):
+    """Reports the exception being handled for a row of a formula file that cannot be read;
+       returns the row as ("line N", None), to be output as an error in its place
+    """
+    report_error("formula file", lineNum, io.StringIO())
+    return ("line " + str(lineNum), None)
+
+def parse_shared_formula_file(file_format,
+                              infile,
+                              id_field="id",
+                              math_field="formula",
+                              workers=1,
+                              batch_cost=BATCH_COST,
+                              utilization=False,
+                              max_rss=0,
+                              max_tasks=0,
+                              fout=None,
+                              **options):
+    """As for parse_formula_file, but the input file is memory-mapped by every process and the workers are sent only
+       (batch, offset, length) spans of whole lines; each worker writes its output for a span to a file in shared
+       memory, returning only its length, for the parent to copy to fout; rows of a TSV file must be single lines
+
+    Parameters:
+        infile: name of an uncompressed input file
+        batch_cost: bytes of input sent to a worker at a time, each longer line alone
+        others: as for parse_formula_file
+    """
+    outdir = shared_directory()
+    try:
+        with (fout or OutputSink(sys.stdout.buffer)) as fout:
+            if os.path.getsize(infile) == 0:
+                return
+            data = mapped_input(infile)
+            start = 0
+            if file_format == "tsv" and not (id_field.isdigit() and math_field.isdigit()):
+                start = data.find(b"\n") + 1 or len(data)
+                header = next(csv.reader([data[:start].decode(ENCODING, "surrogateescape")], delimiter="\t"), [])
+                (id_field, math_field) = (str(col) for col in tsv_columns(header, id_field, math_field))
+            span_options = {"infile": infile, "file_format": file_format, "id_field": id_field,
+                            "math_field": math_field, "outdir": outdir, "options": options}
+            def spans():
+                line = 1 + data[:start].count(b"\n")  # of the span's first line
+                for (batch, (offset, length)) in enumerate(line_spans(data, start, max(1, batch_cost))):
+                    yield (batch, offset, length, line)
+                    line += data[offset:offset + length].count(b"\n")
+            # each span is already a batch
+            methods = Counter()
+            with WorkerPool(convert_formula_span, span_options, workers=workers,
+                            cost=lambda span: span[2], batch_cost=0,
+                            max_rss=max_rss, max_tasks=max_tasks) as pool:
+                for (batch, length, span_methods) in pool.imap(spans()):
+                    name = os.path.join(outdir, str(batch))
+                    with open(name, "rb") as out:
+                        fout.write_bytes(out.read())
+                    os.remove(name)
+                    methods.update(span_methods)
+                if utilization:
+                    pool.report()
+        LatexToSLT.report(file=sys.stderr, counts=methods)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+def line_spans(data, start, batch_cost):
+    """Returns (offset, length) spans of whole lines of data from start, of about batch_cost bytes each;
+       a line of batch_cost bytes or more is a span by itself
+    """
+    size = len(data)
+    while start < size:
+        limit = start + batch_cost
+        if limit >= size:
+            yield (start, size - start)
+            return
+        end = data.find(b"\n", limit - 1)
+        end = size if end < 0 else end + 1
+        last = data.rfind(b"\n", start, limit - 1) + 1 or start  # start of the line ending the span
+        if last > start and end - last >= batch_cost:
+            yield (start, last - start)
+            start = last
+        yield (start, end - start)
+        start = end
+
+def convert_formula_span(span, options):
+    """Converts the formulas in a (batch, offset, length, first line number) span of lines of the memory-mapped
+       input file, writing id<TAB>tuples lines to the file named by the batch in the shared output directory;
+       returns the batch, the number of bytes written, and how many LaTeX formulas were converted each way
+    """
+    (batch, offset, length, line) = span
+    data = mapped_input(options["infile"])
+    fin = io.StringIO(data[offset:offset + length].decode(ENCODING, "surrogateescape"), newline="\n")
+    read = read_tsv if options["file_format"] == "tsv" else read_jsonl
+    methods = Counter()
+    out = []
+    for record in prepare_formulas(list(read(fin, options["id_field"], options["math_field"], line)), options["options"]):
+        (formula_id, ex, method) = convert_formula(record, options["options"])
+        out.append(formula_id + "\t" + ex + "\n")
+        methods[method] += 1
+    out = "".join(out).encode(ENCODING, "surrogateescape")
+    with open(os.path.join(options["outdir"], str(batch)), "wb") as f:
+        f.write(out)
+    return (batch, len(out), methods)
+
+def formula_cost(record):
+    """Estimates the work to convert a (formula id, MathML or LaTeX) pair from its length and number of tags;
+       LaTeX is weighted by the size of the MathML it becomes
+    """
+    math = record[1] or ""
+    if not math.lstrip().startswith("<"):  # LaTeX
+        return 100 + 20 * len(math)
+    return 100 + len(math) + 10 * math.count("<")
+
+def prepare_formulas(batch, options):
+    """Returns a batch of (formula id, MathML or LaTeX) pairs with its LaTeX formulas converted to MathML, each as
+       a (formula id, MathML, "native" or "fallback") triple for convert_formula; those LatexToSLT does not support
+       are converted together, by one latexmlc run (see LatexMLPool) rather than one latexmlmath run each
+       (if that fails, the batch is returned as is, so that convert_formula converts and reports each formula)
+    """
+    prepared = list(batch)
+    pending = []  # positions of formulas for LaTeXML
+    for (i, (formula_id, math)) in enumerate(batch):
+        if math is None or math.lstrip().startswith("<"):
+            continue
+        try:
+            prepared[i] = (formula_id, LatexToSLT.convert_to_mathml(math, fallback=False), "native")
+        except UnsupportedLatexException:
+            pending.append(i)
+        except Exception:
+            pass  # reported by convert_formula
+    if not pending:
+        return prepared
+    try:
+        with LatexMLPool(workers=1, batch_size=len(pending)) as pool:
+            converted = pool.convert_all([batch[i][1] for i in pending])
+        for (i, mathml) in zip(pending, converted):
+            pmml = ET.tostring(MathExtractor.isolate_mml(mathml), encoding="unicode")
+            LatexToSLT.counts["fallback"] += 1
+            prepared[i] = (batch[i][0], pmml, "fallback")
+    except Exception:
+        return batch
+    return prepared
+
+def convert_formula(record, options):
+    """Returns the formula id, the math tuples, and how the formula was converted to MathML ("native" or "fallback",
+       as counted by LatexToSLT, or "" if it was MathML) for a (formula id, MathML or LaTeX) pair
+       (a pair without a formula, from bad_row, has already been reported, and only its error is output;
+       a triple, from prepare_formulas, holds MathML converted from LaTeX and how it was converted)
+    """
+    (formula_id, math) = record[:2]
+    if math is None:
+        return (formula_id, "#(error)#", "")
+    latex = len(record) == 2 and not math.lstrip().startswith("<")
+    fallbacks = LatexToSLT.counts["fallback"]
+    try:
+        if latex:
+            math = LatexToSLT.convert_to_mathml(math)
+        ex = convert_math_expression(formula_id, 0, math, **options)
+    except Exception as err:
+        out = io.StringIO()
+        report_error(formula_id, 0, out)
+        ex = out.getvalue().strip()
+    if len(record) == 3:
+        method = record[2]
+    else:
+        method = "" if not latex else "fallback" if LatexToSLT.counts["fallback"] > fallbacks else "native"
+    return (formula_id, ex, method)
+
+def convert_indexed_formula(index, docid, ordinal, **options):
+    """Returns the math tuples for one math expression, read with a seek from the input file recorded in index
+
+    Parameters:
+        index: FormulaIndex (or the name of its file) written while converting the input with -index
+        docid: id of the document holding the math expression
+        ordinal: position of the math expression in the document (from 1)
+        options: as for convert_math_expression
+    """
+    if isinstance(index, str):
+        index = FormulaIndex(index)
+    return convert_math_expression(docid, ordinal, index.fetch_math(docid, ordinal), **options)
+
+def report_error(mathID, lineNum, fout):
+    """Describes the exception being handled on stderr and marks its place in the output
+    """
+    print("Error in data file or query "+ mathID +", line "+ str(lineNum), file=sys.stderr)
+    stack = traceback.format_exc().split("\n")
+    where = ""
+    pgm = PgmMatch.search(stack[-4])
+    if pgm:
+        where = pgm.group(1) + pgm.group(2)
+    print("    program file",where,stack[-3].strip(),stack[-2].strip(),stack[-1],file=sys.stderr)
+    fout.write("#(error)# ")
 
 def convert_math_expression(mathID,lineNum,mathml,
                             slt=True,
@@ -152,11 +838,14 @@ def convert_math_expression(mathID,lineNum,mathml,
                             window_size=1,
                             loc_info={},
                             anchors=[],
-                            include_latex = False):
+                            include_latex = False,
+                            limits={},
+                            deadline=0,
+                            skipped=None):
     """Returns the math tuples for a given math expression
 
     Parameters:
-        mathml: the math expression (string)
+        mathml: the math expression (string or Element without namespaces)
         (slt): True if SLT features to be extracted
         (opt): True if OPT features to be extracted
         (synonyms): True to expand nodes to include wildcard expansion (during indexing only)
@@ -166,21 +855,95 @@ def convert_math_expression(mathID,lineNum,mathml,
         (loc_info): dictionary of feature types to maximum length of locations to record
         (anchors): list of operators that reset location calculations
         (include_latex): True if altext should also be included
+        (limits): maximum "bytes" of MathML (a larger formula is skipped without being converted), "nodes" in its
+                  trees, "tuples" (as estimated before they are formatted), and "seconds" for the formula;
+                  past a limit, location tuples are dropped, then synonyms, then duplicates (see DEGRADATIONS),
+                  and what was dropped is reported on stderr;
+                  the "cap" on tuples then keeps those first in the order of STAGES (see capped_tuples)
+        (deadline): if positive, the seconds allowed for the formula: features are computed in the order of STAGES
+                    (SLT symbol pairs, then terminal and compound symbols, then duplicates, then the OPT), and
+                    stages after the first that have not started by the deadline are skipped
+        (skipped): list to which the names of any skipped stages are appended
     Returns:
         : a string of the math tuples
     """
+    trivial = None
+    if slt and not opt and not include_latex and not deadline and isinstance(mathml, str):
+        trivial = trivial_math(mathml)
+        if trivial:
+            trivial = (trivial, synonyms, dups, wild_dups, window_size,
+                       tuple(sorted(loc_info.items())), tuple(anchors), tuple(sorted(limits.items())))
+            if trivial in TRIVIAL_TUPLES:
+                return TRIVIAL_TUPLES[trivial]
+    start = time.perf_counter()
+    exceeded = None
+    if limits.get("bytes"):
+        if isinstance(mathml, str):
+            size = len(mathml.encode(ENCODING, "surrogateescape"))
+        else:  # an Element (as from --xml) is measured as serialized, which costs much less than converting it
+            (tail, mathml.tail) = (mathml.tail, None)  # the text after it is not part of it
+            size = len(ET.tostring(mathml, encoding=ENCODING))
+            mathml.tail = tail
+        if size > limits["bytes"]:  # too large even to parse
+            print("Formula limits exceeded in data file or query " + mathID + ", line " + str(lineNum)
+                  + " (bytes %d > %d): skipped" % (size, limits["bytes"]), file=sys.stderr)
+            return ""
     try:
-        pmml = MathExtractor.isolate_mml(mathml,wants_cmml=False) if slt else None
-        cmml = MathExtractor.isolate_mml(mathml,wants_cmml=True) if opt else None       
+        if opt and slt and not isinstance(mathml, str):
+            # an Element is isolated in place, so keep mathml whole for the Content MML
+            pmml = MathExtractor.isolate_mml(copy.deepcopy(mathml),wants_cmml=False)
+        else:
+            pmml = MathExtractor.isolate_mml(mathml,wants_cmml=False) if slt else None
+        cmml = MathExtractor.isolate_mml(mathml,wants_cmml=True) if opt and not deadline else None
     except: # MathML is mal-formed
+        if not isinstance(mathml, str):
+            mathml = ET.tostring(mathml, encoding="unicode")
         print("Badly formed MathML expression in data file or query "+ mathID +", line " + str(lineNum) + ": " + mathml,file=sys.stderr)
         return ""
 
     # convert MathML nodes to SLT and/or OPT
     tree_root = [MathSymbol.tree_from_mathml(pmml) if pmml else None,
                  MathSymbol.tree_from_mathml(cmml) if cmml else None]
-    ret_list = []
+    if limits.get("nodes") and not exceeded:
+        size = sum(tree_size(t) for t in tree_root if t)
+        if size > limits["nodes"]:
+            exceeded = "nodes %d > %d" % (size, limits["nodes"])
+    # drop features, in the order of DEGRADATIONS, while the formula is past its limits
+    # (all of them, without computing duplicates, if past its nodes or seconds already)
+    degradations = [d for (d, applies) in zip(DEGRADATIONS, [max(loc_info.values(), default=0) > 1, synonyms, dups + wild_dups])
+                    if applies]
+    if exceeded is None:
+        exceeded = formula_limits_exceeded(limits, 0, start)
+    level = len(degradations) if exceeded else 0
+    repetitions = "" if "duplicates" in degradations[:level] else dups + wild_dups
+    features = []
     cmml = False
+    if deadline:
+        # compute the most valuable features first, and the OPT (not yet isolated) last
+        stages = [stage for (stage, applies) in zip(STAGES, [tree_root[0] and SYMBOL_PAIR_NODE in loc_info,
+                                                             tree_root[0] and (TERMINAL_NODE in loc_info or
+                                                                               COMPOUND_NODE in loc_info),
+                                                             tree_root[0] and repetitions,
+                                                             opt])
+                  if applies]
+        pairs = []
+        for (n, stage) in enumerate(stages):
+            if n > 0 and time.perf_counter() - start >= deadline:
+                if skipped is not None:
+                    skipped.extend(stages[n:])
+                break
+            if stage == "opt":
+                try:
+                    content = MathExtractor.isolate_mml(mathml,wants_cmml=True)
+                except: # MathML is mal-formed
+                    print("Badly formed Content MathML in data file or query "+ mathID +", line " + str(lineNum),file=sys.stderr)
+                    content = None
+                tree_root[1] = MathSymbol.tree_from_mathml(content) if content else None
+            else:
+                pairs.extend(tree_features(tree_root[0], False, window_size, loc_info, repetitions, anchors, stage))
+        if tree_root[0]:
+            features.append((tree_root[0], pairs, False))
+        tree_root[0] = None
     for t in tree_root:
         # print("tree: " + (t.toString() if t else "None"))
         if not t:
@@ -194,7 +957,7 @@ def convert_math_expression(mathID,lineNum,mathml,
                                     symbol_pairs=(SYMBOL_PAIR_NODE in loc_info),
                                     compound_symbols=(COMPOUND_NODE in loc_info and not cmml),
                                     terminal_symbols=(TERMINAL_NODE in loc_info and not cmml),
-                                    repetitions= dups + wild_dups,
+                                    repetitions= repetitions,
                                     repDict=repDict,
                                     # max_dup=MAX_DUP,
                                     anchors=anchors)
@@ -208,27 +971,144 @@ def convert_math_expression(mathID,lineNum,mathml,
                     break
         """
 
+        features.append((t, pairs, cmml))
+        cmml = True
+
+    while True:
+        dropped = degradations[:level]
+        synonyms_kept = synonyms and "synonyms" not in dropped
+        loc_kept = dict.fromkeys(loc_info, 1) if "locations" in dropped else loc_info
+        estimate = estimate_tuples(features, dups, wild_dups, synonyms_kept, loc_kept, "duplicates" in dropped)
+        over = formula_limits_exceeded(limits, estimate, start)
+        if over is None or level == len(degradations):
+            break
+        exceeded = over
+        level = len(degradations) if over.startswith("seconds") else level + 1
+    exceeded = exceeded or over
+    if exceeded:
+        print("Formula limits exceeded in data file or query " + mathID + ", line " + str(lineNum) + " (" + exceeded + "): "
+              + ("dropped " + ", ".join(dropped) if dropped else "nothing to drop")
+              + ("; still " + over if over and dropped else ""),
+              file=sys.stderr)
+    payloads = []
+    for (t, pairs, cmml) in features:
         # all tokens returned include their location
         # replace query wildcards and expand with wildcards if synonyms
         node_list = [expanded_node
                      for node in pairs
-                     for expanded_node in expand_node_with_wildcards(node,dups,wild_dups,synonyms)
+                     if not ("duplicates" in dropped and determine_node(node) == DUPLICATE_NODE)
+                     for expanded_node in expand_node_with_wildcards(node,dups,wild_dups,synonyms_kept)
                      ]
         # create a list of nodes with locations, as specified
-        nodes_payloads = expand_nodes_with_location(node_list, loc_info)
+        nodes_payloads = expand_nodes_with_location(node_list, loc_kept)
 
         if not pairs:   # nothing returned for non-empty tree, so return the root
             nodes_payloads.append((t.tag, "!0"))
 
-        ret_list = ret_list + [format_node(node) for node in nodes_payloads]
-        cmml = True
+        payloads.extend((cmml, node) for node in nodes_payloads)
+    if limits.get("cap") and len(payloads) > limits["cap"]:
+        print("Formula tuples capped in data file or query " + mathID + ", line " + str(lineNum) + ": kept "
+              + str(limits["cap"]) + " of " + str(len(payloads)), file=sys.stderr)
+        payloads = capped_tuples(payloads, limits["cap"])
+        exceeded = "cap"
+    ret_list = [format_node(node) for (cmml, node) in payloads]
 
     # add start and end strings
     if include_latex and pmml:
         latex = pmml.attrib.get('alttext') if pmml else ""
         ret_list.append(START_ALT + latex + END_ALT)
     ret_list = [START_TAG] + ret_list + [END_TAG]
-    return " ".join(ret_list)
+    result = " ".join(ret_list)
+    if trivial and not exceeded and len(TRIVIAL_TUPLES) < MAX_TRIVIAL:  # only complete results are reused
+        TRIVIAL_TUPLES[trivial] = result
+    return result
+
+def convert_math_query(mathID, lineNum, mathml, deadline, **options):
+    """Returns the math tuples for a math expression computed within deadline seconds, as far as possible,
+       and the list of STAGES skipped to meet it (empty if the tuples are complete); options as for convert_math_expression
+    """
+    skipped = []
+    return (convert_math_expression(mathID, lineNum, mathml, deadline=deadline, skipped=skipped, **options), skipped)
+
+def tree_features(tree, cmml, window_size, loc_info, repetitions, anchors, stage=None):
+    """Returns the features of a math tree, or only those of one of the STAGES
+    """
+    return tree.get_features("",    # root's location is empty string
+                             window_size,
+                             cmml = cmml,
+                             symbol_pairs=(SYMBOL_PAIR_NODE in loc_info and stage in (None, "pairs")),
+                             compound_symbols=(COMPOUND_NODE in loc_info and not cmml and stage in (None, "terminals")),
+                             terminal_symbols=(TERMINAL_NODE in loc_info and not cmml and stage in (None, "terminals")),
+                             repetitions=repetitions if stage in (None, "duplicates") else "",
+                             repDict={},
+                             anchors=anchors)
+
+def estimate_tuples(features, dups, wild_dups, synonyms, loc_info, drop_duplicates=False):
+    """Returns the number of math tuples that the features of a formula's trees, a list of (tree, features, cmml),
+       will expand to, without expanding or formatting them (options as for convert_math_expression)
+    """
+    count = 0
+    for (t, pairs, cmml) in features:
+        if not pairs:   # the root alone
+            count += 1
+        for node in pairs:
+            node_type = determine_node(node)
+            if drop_duplicates and node_type == DUPLICATE_NODE:
+                continue
+            # as for expand_node_with_wildcards
+            if node_type == DUPLICATE_NODE:
+                type = make_wild(node[1])
+                variants = ((type[2:3] in dups and type != WILDCARD_MOCK)
+                            + (type[2:3] in wild_dups or synonyms or type == WILDCARD_MOCK))
+            elif node_type == SYMBOL_PAIR_NODE:
+                if check_wildcard(node[0]):
+                    variants = 0 if check_wildcard(node[1]) else 1
+                elif check_wildcard(node[1]):
+                    variants = 1
+                else:
+                    variants = 3 if synonyms else 1
+            elif node_type == COMPOUND_NODE:
+                variants = 2 if synonyms and not check_wildcard(node[0]) else 1
+            else:
+                variants = 0 if check_wildcard(node[0]) else 1
+            if variants:
+                # as for expand_nodes_with_location
+                depth = loc_info[node_type]
+                loc_len = 1 + len(MathSymbol.decode_loc(node[-1]))
+                count += variants * (2 if loc_len < depth or depth >= INFINITE_DEPTH else 1)
+    return count
+
+def capped_tuples(payloads, cap):
+    """Returns the cap (cmml, node) payloads that come first in the order of STAGES (symbol pairs, terminal and
+       compound symbols, duplicates, then all OPT tuples), each in the order produced; those kept stay in their order
+    """
+    rank = {SYMBOL_PAIR_NODE: 0, TERMINAL_NODE: 1, COMPOUND_NODE: 1, DUPLICATE_NODE: 2}
+    order = sorted(range(len(payloads)),
+                   key=lambda i: (3 if payloads[i][0] else rank[determine_node(payloads[i][1])], i))
+    keep = set(order[:cap])
+    return [payload for (i, payload) in enumerate(payloads) if i in keep]
+
+def formula_limits_exceeded(limits, tuples, start):
+    """Returns which of the limits on tuples and seconds (since start) is exceeded, else None
+    """
+    if limits.get("tuples") and tuples > limits["tuples"]:
+        return "tuples %d > %d" % (tuples, limits["tuples"])
+    if limits.get("seconds"):
+        seconds = time.perf_counter() - start
+        if seconds > limits["seconds"]:
+            return "seconds %.3f > %g" % (seconds, limits["seconds"])
+    return None
+
+def tree_size(tree):
+    """Returns the number of nodes in a math tree
+    """
+    size = 0
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        size += 1
+        nodes.extend(child for child in node.children if child)
+    return size
 
 def expand_node_with_wildcards(node, dups, wild_dups, synonyms):
     """Returns a list of nodes that replaces wildcards in all non-duplicates and
@@ -417,12 +1297,14 @@ if __name__ == "__main__":
                       anchors enabled, dups = 'VNOMFRTW', wild_dups = 'VNOMFRTW'
     '''
     parser = argparse.ArgumentParser(description=descp,epilog=epilog,formatter_class=argparse.RawDescriptionHelpFormatter)
-    #    parser.add_argument('-infile',
-    #                        default=None,
-    #                        help='The file to read from; omitted =>stdin')
-    #    parser.add_argument('-outfile',
-    #                        default=None,
-    #                        help='The file to output to; omitted => stdout')
+    parser.add_argument('-infile','--infile',
+                        dest="infile",
+                        default=None,
+                        help='The file to read from (decompressed if .gz, .bz2, or .xz); omitted => stdin')
+    parser.add_argument('-outfile','--outfile',
+                        dest="outfile",
+                        default=None,
+                        help='The file to output to (compressed if .gz, .bz2, or .xz); omitted => stdout')
     parser.add_argument("-W",'--window_size',
                         dest="window_size",
                         default=1,
@@ -489,7 +1371,194 @@ if __name__ == "__main__":
                         dest="wild_dups",
                         help="Wild duplication tuples for subset of 'VNOMFRTW'**",
                         default="VNOMFRTW")
+    parser.add_argument("-x",'--xml',
+                        dest="xml",
+                        action="store_true",
+                        help="Parse input as one well-formed XML document (docid names the id element); default => scan lines",
+                        default=False)
+    parser.add_argument("-r",'--records',
+                        dest="records",
+                        help="Stream input as XML records with this tag (e.g., row), converting the HTML in each record's body",
+                        default=None)
+    parser.add_argument('--record-id',
+                        dest="record_id",
+                        help="Attribute holding each record's id; default = Id",
+                        default="Id")
+    parser.add_argument('--record-body',
+                        dest="record_body",
+                        help="Attribute holding each record's body (else its text); default = Body",
+                        default="Body")
+    parser.add_argument('--tsv',
+                        dest="tsv",
+                        action="store_true",
+                        help="Input is one formula (MathML or LaTeX) per tab-separated row; output is id<TAB>tuples",
+                        default=False)
+    parser.add_argument('--jsonl',
+                        dest="jsonl",
+                        action="store_true",
+                        help="Input is one formula (MathML or LaTeX) per JSON line; output is id<TAB>tuples",
+                        default=False)
+    parser.add_argument('--id-field',
+                        dest="id_field",
+                        help="Column name or number (TSV) or key (JSONL) of each formula's id; default = id",
+                        default="id")
+    parser.add_argument('--math-field',
+                        dest="math_field",
+                        help="Column name or number (TSV) or key (JSONL) of each formula; default = formula",
+                        default="formula")
+    parser.add_argument("-j",'--workers',
+                        dest="workers",
+                        help="Number of processes converting formulas (with --tsv or --jsonl); default = 1",
+                        default=1,
+                        type=int)
+    parser.add_argument('--batch-cost',
+                        dest="batch_cost",
+                        help="Estimated cost of the formulas sent to a worker at a time, each larger formula alone (0 => chunks of 64 formulas); default = "+str(BATCH_COST),
+                        default=BATCH_COST,
+                        type=int)
+    parser.add_argument('--shared',
+                        dest="shared",
+                        action="store_true",
+                        help="Memory-map -infile in every worker and pass only offsets of its lines (with --tsv or --jsonl)",
+                        default=False)
+    parser.add_argument('--utilization',
+                        dest="utilization",
+                        action="store_true",
+                        help="Report each worker's batches, formulas, and time busy on stderr (with --tsv or --jsonl)",
+                        default=False)
+    parser.add_argument('--max-worker-rss',
+                        dest="max_worker_rss",
+                        help="Replace a worker whose resident memory exceeds this many MiB, resending its task (0 => no limit); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--max-worker-tasks',
+                        dest="max_worker_tasks",
+                        help="Replace a worker after this many batches of formulas (0 => no limit); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--latex-cache',
+                        dest="latex_cache",
+                        help="Remember LaTeXML's conversions of LaTeX formulas in this sqlite file, reused by later runs (with --tsv or --jsonl)",
+                        default=None)
+    parser.add_argument("-m",'--mmap',
+                        dest="mmap",
+                        action="store_true",
+                        help="Scan the input file (not a pipe) as memory-mapped bytes, decoding only the math",
+                        default=False)
+    parser.add_argument('--max-math-bytes',
+                        dest="max_math_bytes",
+                        help="Abandon an unterminated math expression after this many bytes (0 => unlimited); default = %d" % MAX_MATH_BYTES,
+                        default=MAX_MATH_BYTES,
+                        type=int)
+    parser.add_argument('--max-math-lines',
+                        dest="max_math_lines",
+                        help="Abandon an unterminated math expression after this many lines (0 => unlimited); default = %d" % MAX_MATH_LINES,
+                        default=MAX_MATH_LINES,
+                        type=int)
+    parser.add_argument('--max-formula-bytes',
+                        dest="max_formula_bytes",
+                        help="Skip (rather than degrade), without converting it, a formula of more than this many bytes of MathML (0 => unlimited); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--max-formula-nodes',
+                        dest="max_formula_nodes",
+                        help="Degrade the tuples of a formula whose trees have more than this many nodes (0 => unlimited); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--max-formula-tuples',
+                        dest="max_formula_tuples",
+                        help="Degrade the tuples of a formula that has more than this many (0 => unlimited); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--max-formula-seconds',
+                        dest="max_formula_seconds",
+                        help="Degrade the tuples of a formula taking more than this many seconds (0 => unlimited); default = 0",
+                        default=0,
+                        type=float)
+    parser.add_argument('--cap-formula-tuples',
+                        dest="cap_formula_tuples",
+                        help="Keep at most this many tuples of a formula, symbol pairs first, then terminal and compound symbols, then duplicates, then OPT (0 => unlimited); default = 0",
+                        default=0,
+                        type=int)
+    parser.add_argument('--output-buffer',
+                        dest="output_buffer",
+                        help="Bytes of output to collect before writing; default = %d" % BUFFER_SIZE,
+                        default=BUFFER_SIZE,
+                        type=int)
+    parser.add_argument('--writev',
+                        dest="writev",
+                        action="store_true",
+                        help="Write the collected output with one os.writev call per batch of chunks; default => join them first",
+                        default=False)
+    parser.add_argument('--range',
+                        dest="range",
+                        help="Convert only bytes START:END (END exclusive) of -infile, e.g., a shard starting at a docid",
+                        default=None)
+    parser.add_argument('--checkpoint',
+                        dest="checkpoint",
+                        help="Save the progress in OUTFILE.checkpoint at a document boundary every this many seconds (0 => never); default = 0",
+                        default=0,
+                        type=float)
+    parser.add_argument('--resume',
+                        dest="resume",
+                        action="store_true",
+                        help="Continue from OUTFILE.checkpoint (if any), truncating OUTFILE to the output saved there",
+                        default=False)
+    parser.add_argument('--only-docids',
+                        dest="only_docids",
+                        help="Convert only the documents (or records) whose ids are listed, one per line, in this file",
+                        default=None)
+    parser.add_argument('--exclude-docids',
+                        dest="exclude_docids",
+                        help="Skip the documents (or records) whose ids are listed, one per line, in this file",
+                        default=None)
+    parser.add_argument('--index',
+                        dest="index",
+                        help="Record the byte offsets of the documents and math expressions of -infile in this file",
+                        default=None)
+    parser.add_argument('--spans',
+                        dest="spans",
+                        help="Record in this file the spans of each formula in the input and of its tuples in the output",
+                        default=None)
+    parser.add_argument('--manifest',
+                        dest="manifest",
+                        help="Reuse the output stored in this file for documents unchanged since the last run (and store the rest)",
+                        default=None)
     args = parser.parse_args()
+    if args.mmap and args.infile and codec(args.infile):
+        parser.error("--mmap cannot scan a compressed file")
+    if args.mmap and not (os.path.isfile(args.infile) if args.infile else stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)):
+        parser.error("--mmap needs a file (not a pipe) as input")
+    if args.xml and args.context:
+        parser.error("--xml returns tuples only, so it cannot be combined with --context")
+    if args.xml and args.records:
+        parser.error("--xml and --records cannot be combined")
+    if args.range:
+        if not args.infile or codec(args.infile) or not re.fullmatch(r"\d+:\d+", args.range):
+            parser.error("--range needs START:END and an uncompressed -infile")
+        if args.xml or args.records or args.tsv or args.jsonl or args.mmap or args.manifest or args.checkpoint > 0 or args.resume:
+            parser.error("--range applies only when scanning lines, without --manifest, --checkpoint, or --resume")
+    if args.checkpoint > 0 or args.resume:
+        if not (args.infile and args.outfile) or codec(args.outfile):
+            parser.error("--checkpoint and --resume need -infile and an uncompressed -outfile")
+        if args.xml or args.records or args.tsv or args.jsonl or args.mmap:
+            parser.error("--checkpoint and --resume apply only when scanning lines")
+    if args.manifest and (args.xml or args.records or args.tsv or args.jsonl or args.mmap or args.checkpoint > 0 or args.resume):
+        parser.error("--manifest applies only when scanning lines, without --checkpoint or --resume")
+    if (args.only_docids or args.exclude_docids) and (args.xml or args.tsv or args.jsonl or args.mmap):
+        parser.error("--only-docids and --exclude-docids apply only when scanning lines or streaming records")
+    if args.latex_cache and not (args.tsv or args.jsonl):
+        parser.error("--latex-cache applies only with --tsv or --jsonl")
+    if args.index and (not args.infile or args.xml or args.records or args.tsv or args.jsonl or args.manifest):
+        parser.error("--index needs -infile and applies only when scanning lines or memory-mapped bytes, without --manifest")
+    if args.spans and (args.xml or args.records or args.tsv or args.jsonl or args.mmap or args.manifest):
+        parser.error("--spans applies only when scanning lines, without --manifest")
+    if args.shared and (not (args.tsv or args.jsonl) or not args.infile or codec(args.infile) or args.range):
+        parser.error("--shared needs --tsv or --jsonl and an uncompressed -infile (without --range)")
+    if (args.max_worker_rss or args.max_worker_tasks) and not (args.tsv or args.jsonl):
+        parser.error("--max-worker-rss and --max-worker-tasks apply only with --tsv or --jsonl")
+    if args.manifest and not args.docid:
+        parser.error("--manifest needs -docid to separate the documents")
 
     # rationalize indicators for duplicates
     dups = args.dups
@@ -520,7 +1589,172 @@ if __name__ == "__main__":
             dels.append(node_type)   # do not include these tuples as features
     for d in dels:
         del loc_info[d]
+    # store per-formula limits, past which location tuples, then synonyms, then duplicates are dropped (and the cap)
+    limits = {limit: value
+              for (limit, value) in [("bytes", args.max_formula_bytes), ("nodes", args.max_formula_nodes),
+                                     ("tuples", args.max_formula_tuples), ("seconds", args.max_formula_seconds),
+                                     ("cap", args.cap_formula_tuples)]
+              if value > 0}
+    only_docids = read_docids(args.only_docids) if args.only_docids else None
+    exclude_docids = read_docids(args.exclude_docids) if args.exclude_docids else None
+    fin = open_input(args.infile) if args.infile else None
+    (id_field, math_field, line) = (args.id_field, args.math_field, 1)
+    if args.tsv and not (id_field.isdigit() and math_field.isdigit()):
+        fin = fin or sys.stdin.buffer
+        try:
+            (id_field, math_field) = tsv_header(fin, id_field, math_field)  # so that rows are read from line 2
+            line = 2
+        except ValueError as err:
+            parser.error(str(err))
+    if args.latex_cache:
+        LatexToMathML.use_cache(path=args.latex_cache)  # opened again by each worker that uses it
+    spans = FormulaSpans(args.spans) if args.spans else None
+    index = FormulaIndex(args.index, infile=os.path.abspath(args.infile), clear=not args.resume) if args.index else None
+    output = args.outfile or sys.stdout.buffer
+    checkpoint = None
+    offset = 0
+    if args.checkpoint > 0 or args.resume:
+        checkpoint = Checkpoint(args.outfile + ".checkpoint", args.infile, interval=args.checkpoint or INTERVAL)
+    if args.resume:
+        try:
+            state = checkpoint.load()
+        except ValueError as err:
+            parser.error(str(err))
+        if state:
+            print("Resuming at document " + state["docid"] + ", byte " + str(state["offset"]) + " of " + args.infile, file=sys.stderr)
+            offset = state["offset"]
+            skip(fin, offset)
+            output = open(args.outfile, "r+b")
+            output.truncate(state["output"])
+            output.seek(state["output"])
+    if args.range:
+        (start, end) = [int(n) for n in args.range.split(":")]
+        fin.close()
+        fin = open_range(args.infile, start, end)
+        offset = start
+    fout = OutputSink(output, buffer_size=args.output_buffer, writev=args.writev)
 
+    if args.xml:
+        parse_xml_file(docid=args.docid,
+                       slt=args.SLT,
+                       opt=args.OPT,
+                       synonyms=args.synonyms,
+                       dups=dups,
+                       wild_dups=wild_dups,
+                       window_size=args.window_size,
+                       loc_info=loc_info,
+                       anchors=anchors,
+                       include_latex=args.latex,
+                       limits=limits,
+                       fin=fin,
+                       fout=fout)
+        sys.exit(0)
+    if args.shared:
+        fin.close()
+        parse_shared_formula_file("tsv" if args.tsv else "jsonl",
+                                  args.infile,
+                                  id_field=args.id_field,
+                                  math_field=args.math_field,
+                                  workers=args.workers,
+                                  batch_cost=args.batch_cost,
+                                  utilization=args.utilization,
+                                  max_rss=args.max_worker_rss * 2**20,
+                                  max_tasks=args.max_worker_tasks,
+                                  slt=args.SLT,
+                                  opt=args.OPT,
+                                  synonyms=args.synonyms,
+                                  dups=dups,
+                                  wild_dups=wild_dups,
+                                  window_size=args.window_size,
+                                  loc_info=loc_info,
+                                  anchors=anchors,
+                                  include_latex=args.latex,
+                                  limits=limits,
+                                  fout=fout)
+        sys.exit(0)
+    if args.tsv or args.jsonl:
+        parse_formula_file("tsv" if args.tsv else "jsonl",
+                           id_field=id_field,
+                           math_field=math_field,
+                           line=line,
+                           workers=args.workers,
+                           batch_cost=args.batch_cost,
+                           utilization=args.utilization,
+                           max_rss=args.max_worker_rss * 2**20,
+                           max_tasks=args.max_worker_tasks,
+                           slt=args.SLT,
+                           opt=args.OPT,
+                           synonyms=args.synonyms,
+                           dups=dups,
+                           wild_dups=wild_dups,
+                           window_size=args.window_size,
+                           loc_info=loc_info,
+                           anchors=anchors,
+                           include_latex=args.latex,
+                           limits=limits,
+                           fin=fin,
+                           fout=fout)
+        sys.exit(0)
+    if args.records:
+        parse_records_file(args.records,
+                           id_attr=args.record_id,
+                           body_attr=args.record_body,
+                           docid=args.docid,
+                           context=args.context,
+                           slt=args.SLT,
+                           opt=args.OPT,
+                           synonyms=args.synonyms,
+                           dups=dups,
+                           wild_dups=wild_dups,
+                           window_size=args.window_size,
+                           loc_info=loc_info,
+                           anchors=anchors,
+                           include_latex=args.latex,
+                           limits=limits,
+                           fin=fin,
+                           fout=fout,
+                           only_docids=only_docids,
+                           exclude_docids=exclude_docids)
+        sys.exit(0)
+    if args.manifest:
+        options = dict(docid=args.docid,
+                       context=args.context,
+                       slt=args.SLT,
+                       opt=args.OPT,
+                       synonyms=args.synonyms,
+                       dups=dups,
+                       wild_dups=wild_dups,
+                       window_size=args.window_size,
+                       loc_info=loc_info,
+                       anchors=anchors,
+                       include_latex=args.latex,
+                       limits=limits,
+                       max_math_bytes=args.max_math_bytes,
+                       max_math_lines=args.max_math_lines)
+        manifest = Manifest(args.manifest, options)
+        parse_documents(manifest, fin=fin, fout=fout, only_docids=only_docids, exclude_docids=exclude_docids, **options)
+        manifest.close()
+        sys.exit(0)
+    if args.mmap:
+        parse_mapped_file(docid=args.docid,
+                          context=args.context,
+                          max_math_bytes=args.max_math_bytes,
+                          slt=args.SLT,
+                          opt=args.OPT,
+                          synonyms=args.synonyms,
+                          dups=dups,
+                          wild_dups=wild_dups,
+                          window_size=args.window_size,
+                          loc_info=loc_info,
+                          anchors=anchors,
+                          include_latex=args.latex,
+                          limits=limits,
+                          fin=fin,
+                          fout=fout,
+                          index=index)
+        if index:
+            index.close()
+        sys.exit(0)
     parse_file(docid=args.docid,
                context=args.context,
                slt=args.SLT,
@@ -531,5 +1765,22 @@ if __name__ == "__main__":
                window_size=args.window_size,
                loc_info=loc_info,
                anchors=anchors,
-               include_latex=args.latex)
+               include_latex=args.latex,
+               limits=limits,
+               max_math_bytes=args.max_math_bytes,
+               max_math_lines=args.max_math_lines,
+               fin=fin,
+               fout=fout,
+               checkpoint=checkpoint,
+               offset=offset,
+               only_docids=only_docids,
+               exclude_docids=exclude_docids,
+               index=index,
+               spans=spans)
+    if index:
+        index.close()
+    if spans:
+        spans.close()
+    if checkpoint:
+        checkpoint.remove()  # the conversion is complete
     # logger.info("Done")
@@ -34,3 +34,12 @@ class UnknownTagException(Exception):
 
     def __init__(self, tag):
         self.tag = tag
+
+
+class UnsupportedLatexException(Exception):
+    """
+    An exception to indicate LaTeX that cannot be converted without LaTeXML
+    """
+
+    def __init__(self, latex):
+        self.latex = latex
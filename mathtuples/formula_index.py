@@ -0,0 +1,139 @@
+"""
+    mathtuples
+    Side index of the byte offsets of documents and formulas in an input file
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import sqlite3
+from .math_extractor import MathExtractor
+from .streams import open_input, skip
+__author__ = 'FWTompa'
+
+ENCODING = "utf-8"
+BATCH = 10000  # rows inserted at a time
+
+
+class FormulaIndex(object):
+    """
+    Record where each document and each math expression (by docid and ordinal within the document, from 1)
+    lies in an input file (in an sqlite file), so that any one of them can be read again with a seek
+    """
+
+    def __init__(self, path, infile=None, clear=False):
+        """
+        param path: sqlite file holding the index (created if need be)
+        type  path: string
+
+        param (infile): name of the input file being indexed (None => the one already recorded in the index)
+        type  (infile): string
+
+        param (clear): whether to drop what is already in the index (e.g., unless resuming a conversion)
+        type  (clear): boolean
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS input (infile TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents "
+                        "(docid TEXT PRIMARY KEY, offset INTEGER, length INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS formulas "
+                        "(docid TEXT, ordinal INTEGER, offset INTEGER, length INTEGER, PRIMARY KEY (docid, ordinal)) WITHOUT ROWID")
+        if clear:
+            for table in ["input", "documents", "formulas"]:
+                self.db.execute("DELETE FROM " + table)
+        if infile is not None:
+            self.db.execute("DELETE FROM input")
+            self.db.execute("INSERT INTO input VALUES (?)", (infile,))
+        self.db.commit()
+        row = self.db.execute("SELECT infile FROM input").fetchone()
+        self.infile = row[0] if row else None
+        self.ordinals = {}  # last ordinal for each docid
+        self.rows = []
+        self.document = None  # (docid, offset) of the document being indexed
+
+    def add_document(self, docid, offset):
+        """
+        start a document at this byte offset, ending the previous one there
+        """
+        self.end_document(offset)
+        self.document = (docid, offset)
+
+    def end_document(self, offset):
+        if self.document:
+            (docid, start) = self.document
+            if offset > start:  # omit an empty document, e.g., before a docid on the first line
+                self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", (docid, start, offset - start))
+            self.document = None
+
+    def add_formula(self, docid, offset, length):
+        """
+        return: ordinal of this math expression within its document
+        rtype:  int
+        """
+        ordinal = self.ordinals.get(docid, 0) + 1
+        self.ordinals[docid] = ordinal
+        self.rows.append((docid, ordinal, offset, length))
+        if len(self.rows) >= BATCH:
+            self.flush()
+        return ordinal
+
+    def add_formulas(self, docid, content, offset):
+        """
+        index every math expression in content, which starts at this byte offset
+        """
+        (chars, position) = (0, offset)
+        for (start, end, QName, formula_id) in MathExtractor.math_spans(content):
+            position += len(content[chars:start].encode(ENCODING, "surrogateescape"))
+            length = len(content[start:end].encode(ENCODING, "surrogateescape"))
+            self.add_formula(docid, position, length)
+            (chars, position) = (end, position + length)
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO formulas VALUES (?, ?, ?, ?)", self.rows)
+        self.db.commit()
+        self.rows = []
+
+    def finish(self, offset):
+        """
+        end the last document at this byte offset (the end of the input) and save everything
+        """
+        self.end_document(offset)
+        self.flush()
+
+    def locate(self, docid, ordinal=None):
+        """
+        return: byte offset and length of a math expression (or of the document, if ordinal is None), or None if not indexed
+        rtype:  (int, int)
+        """
+        if ordinal is None:
+            return self.db.execute("SELECT offset, length FROM documents WHERE docid = ?", (docid,)).fetchone()
+        return self.db.execute("SELECT offset, length FROM formulas WHERE docid = ? AND ordinal = ?",
+                               (docid, ordinal)).fetchone()
+
+    def fetch(self, docid, ordinal=None):
+        """
+        return: text of a math expression (or of the document, if ordinal is None), read from the indexed input file
+        rtype:  string
+        """
+        place = self.locate(docid, ordinal)
+        if place is None:
+            raise KeyError("%s %s is not in the index" % (docid, "" if ordinal is None else ordinal))
+        (offset, length) = place
+        with open_input(self.infile) as fin:
+            skip(fin, offset)
+            return fin.read(length).decode(ENCODING, "surrogateescape")
+
+    def fetch_math(self, docid, ordinal):
+        """
+        return: MathML of a math expression, with namespaces removed as by MathExtractor.math_tokens
+        rtype:  string
+        """
+        return MathExtractor.math_tokens(self.fetch(docid, ordinal))[0]
+
+    def close(self):
+        if self.db:
+            self.flush()
+            self.db.close()
+            self.db = None
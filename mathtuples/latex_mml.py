@@ -30,22 +30,146 @@ import subprocess
 import sys
 import platform
 import re
+import tempfile
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 __author__ = 'Nidhin, FWTompa'
 
+class LatexCache(object):
+    """
+    Remember LaTeX to MathML conversions so that repeated formulas skip LaTeXML altogether
+
+    Entries are keyed on the normalized LaTeX together with the preloaded packages.
+    The most recently used "capacity" entries are kept in memory; if a path is given,
+    every conversion is also stored in an sqlite database there so that it survives re-runs.
+    A process forked after the cache is created (e.g., a worker) opens the database again for itself.
+    """
+    def __init__(self, capacity=10000, path=None):
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.path = path
+        self.db = None
+        self.pid = None  # process that opened db
+        if path:
+            self.connect()
+
+    def connect(self):
+        """
+        return: the connection to the database, opened in this process (a connection cannot be shared across a fork)
+        rtype:  sqlite3.Connection
+        """
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS latex (key TEXT PRIMARY KEY, mathml TEXT)")
+            self.db.commit()
+            self.pid = os.getpid()
+        return self.db
+
+    @classmethod
+    def key(cls, tex_query, preloads):
+        return "\x1f".join(preloads) + "\x00" + tex_query.strip()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            if self.path:
+                row = self.connect().execute("SELECT mathml FROM latex WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self.hits += 1
+                    self.remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, mathml):
+        with self.lock:
+            self.remember(key, mathml)
+            if self.path:
+                db = self.connect()
+                db.execute("INSERT OR REPLACE INTO latex VALUES (?, ?)", (key, mathml))
+                db.commit()
+
+    def remember(self, key, mathml):
+        self.memory[key] = mathml
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        if self.db and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+        self.path = None
+
+
 class LatexToMathML(object):
+    preloads = ['amsmath', 'amsfonts']  # LaTeX packages loaded before every conversion
+    cache = None  # LatexCache shared by all conversions, once use_cache() is called
+
     @classmethod
-    def convert_to_mathml(cls, tex_query):
-        # print("Convert LaTeX to MathML:$"+tex_query+"$",flush=True)
+    def use_cache(cls, capacity=10000, path=None):
+        """
+        start caching conversions in memory and, if path is given, in an sqlite file
+        """
+        cls.cache = LatexCache(capacity=capacity, path=path)
+        return cls.cache
+
+    @classmethod
+    def cache_key(cls, tex_query):
+        """
+        pre: tex_query has been normalized
+        """
+        return LatexCache.key(tex_query, cls.preloads + [os.path.basename(cls.stylesheet())])
+
+    @classmethod
+    def stylesheet(cls):
+        """
+        locate the LaTeXML binding that defines the wildcard (qvar) macros
+        """
         qvar_template_file = os.path.join(os.path.dirname(__file__),"mws.sty.ltxml")
         if not os.path.exists(qvar_template_file):
             print('Tried %s' % qvar_template_file, end=": ")
-            sys.exit("tex: "+tex_query+ " Stylesheet for wildcard is missing")
+            sys.exit("Stylesheet for wildcard is missing")
+        return qvar_template_file
+
+    @classmethod
+    def preload_args(cls):
+        return ['--preload='+package for package in cls.preloads] + ['--preload='+cls.stylesheet()]
 
+    @classmethod
+    def normalize(cls, tex_query):
         # Make sure there are no isolated % signs in tex_query (introduced by latexmlmath, for example, in 13C.mml test file) (FWT)
-        tex_query = re.sub(r'([^\\])%',r'\1',tex_query) # remove % not preceded by backslashes (FWT)
+        return re.sub(r'([^\\])%',r'\1',tex_query) # remove % not preceded by backslashes (FWT)
+
+    @classmethod
+    def fix_qvars(cls, result):
+        # strangely, not getting expected conversion. Instead      (FWT)
+        #    <mi mathcolor="red" mathvariant="italic">qvar_B</mi>
+        # should have been
+        #    <mws:qvar xmlns:mws="http://search.mathweb.org/ns" name="B"/>
+        return re.sub(r'<mi.*?>qvar_(.*)</mi>', r'<mws:qvar xmlns:mws="http://search.mathweb.org/ns" name="\1"/>', result)  # FWT
+
+    @classmethod
+    def convert_to_mathml(cls, tex_query):
+        # print("Convert LaTeX to MathML:$"+tex_query+"$",flush=True)
+        preload_args = cls.preload_args()
+        tex_query = cls.normalize(tex_query)
+        if cls.cache:
+            key = cls.cache_key(tex_query)
+            result = cls.cache.get(key)
+            if result is not None:
+                return result
 
         use_shell= ('Windows' in platform.system())
-        p2 = subprocess.Popen(['latexmlmath' ,'--pmml=-','--preload=amsmath', '--preload=amsfonts', '--preload='+qvar_template_file, '-'], shell=use_shell, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        p2 = subprocess.Popen(['latexmlmath' ,'--pmml=-'] + preload_args + ['-'], shell=use_shell, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
         (output, err) = p2.communicate(input=tex_query.encode())
         
         if (not output) and err:
@@ -53,12 +177,7 @@ class LatexToMathML(object):
             raise Exception(str(err))
         try:
             result= output.decode('utf-8')
-            # strangely, not getting expected conversion. Instead      (FWT)
-            #    <mi mathcolor="red" mathvariant="italic">qvar_B</mi>
-            # should have been
-            #    <mws:qvar xmlns:mws="http://search.mathweb.org/ns" name="B"/>
-            
-            result = re.sub(r'<mi.*?>qvar_(.*)</mi>', r'<mws:qvar xmlns:mws="http://search.mathweb.org/ns" name="\1"/>', result)  # FWT
+            result = cls.fix_qvars(result)
         except UnicodeDecodeError as uae:
             print("Failed to decode " + uae.reason, file=sys.stderr)
             result=output.decode('utf-8','replace')
@@ -66,4 +185,96 @@ class LatexToMathML(object):
         except:
             print("Failure in converting LaTeX in "+tex_query, file=sys.stderr)
             raise # pass on the exception to identify context
+        if cls.cache:
+            cls.cache.put(key, result)
         return result
+
+
+class LatexMLPool(object):
+    """
+    Convert many LaTeX formulas without paying Perl and preload start-up for each one
+
+    Formulas are grouped into batches, each batch is typeset as a single document by latexmlc
+    (one process instead of one per formula), and up to "workers" batches run concurrently.
+    If a port is given, latexmlc hands each batch to a long-lived latexmls server listening
+    on that port (started on first use and kept alive for "expire" idle seconds), so that
+    even the per-batch start-up cost is paid only once.
+    Formulas found in LatexToMathML.cache are not sent to LaTeXML at all.
+    """
+    math_element = re.compile(r"<math\b.*?</math>", re.DOTALL)
+
+    def __init__(self, workers=2, batch_size=100, port=None, expire=600):
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.port = port
+        self.expire = expire
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def convert_to_mathml(self, tex_query):
+        return self.convert_all([tex_query])[0]
+
+    def convert_all(self, tex_queries):
+        """
+        param tex_queries: LaTeX formulas (without surrounding $ signs)
+        type  tex_queries: list(string)
+        return: Presentation MathML for each formula, in the same order
+        rtype:  list(string)
+        """
+        cache = LatexToMathML.cache
+        results = [None] * len(tex_queries)
+        pending = []  # positions of formulas that must be converted
+        for (i, tex) in enumerate(tex_queries):
+            if cache:
+                results[i] = cache.get(LatexToMathML.cache_key(LatexToMathML.normalize(tex)))
+            if results[i] is None:
+                pending.append(i)
+        batches = [pending[i:i+self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        converted = self.executor.map(self.convert_batch, [[tex_queries[i] for i in batch] for batch in batches])
+        for (batch, mathml) in zip(batches, converted):
+            for (i, result) in zip(batch, mathml):
+                results[i] = result
+                if cache:
+                    cache.put(LatexToMathML.cache_key(LatexToMathML.normalize(tex_queries[i])), result)
+        return results
+
+    def command(self, source, destination):
+        cmd = ['latexmlc', '--pmml', '--format=xhtml', '--nodefaultresources', '--quiet']
+        if self.port:
+            cmd += ['--port=' + str(self.port), '--expire=' + str(self.expire)]
+        return cmd + LatexToMathML.preload_args() + ['--destination=' + destination, source]
+
+    def convert_batch(self, tex_queries):
+        """
+        typeset one batch as a single document, with one formula per paragraph;
+        fall back to one latexmlmath call per formula if the formulas cannot be matched up
+        """
+        body = "\n\n".join("$" + LatexToMathML.normalize(tex) + "$" for tex in tex_queries)
+        document = "\\documentclass{article}\n\\begin{document}\n" + body + "\n\n\\end{document}\n"
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "batch.tex")
+            destination = os.path.join(tmp, "batch.xhtml")
+            with open(source, "w", encoding="utf-8") as f:
+                f.write(document)
+            use_shell= ('Windows' in platform.system())
+            p = subprocess.run(self.command(source, destination), shell=use_shell, cwd=tmp,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = ""
+            if os.path.exists(destination):
+                with open(destination, encoding="utf-8", errors="replace") as f:
+                    output = f.read()
+        exprs = self.math_element.findall(output)
+        if len(exprs) != len(tex_queries):  # a formula was dropped or split: convert one at a time
+            print("LaTeXML batch of %d formulas returned %d; converting individually" % (len(tex_queries), len(exprs)), file=sys.stderr)
+            if p.returncode != 0 and p.stderr:
+                print(p.stderr.decode('utf-8','replace').strip(), file=sys.stderr)
+            return [LatexToMathML.convert_to_mathml(tex) for tex in tex_queries]
+        return [LatexToMathML.fix_qvars(expr) for expr in exprs]
@@ -0,0 +1,379 @@
+"""
+    mathtuples
+    Convert common LaTeX formulas to symbol layout trees without LaTeXML
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import re
+import sys
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+from .mathml import MathML
+from .mathsymbol import MathSymbol
+from .math_extractor import MathExtractor
+from .latex_mml import LatexToMathML
+from .exceptions import UnsupportedLatexException
+
+__author__ = 'FWTompa'
+
+'''
+Only a common subset of LaTeX is recognized: letters, numbers, operators and relations,
+Greek letters, sub- and superscripts, primes, \\frac, \\sqrt, \\text, \\mathbb, \\mathrm,
+\\qvar, \\left ... \\right, parentheses, brackets and braces, and the (p|b|B|v|V)matrix environments.
+The Presentation MathML built for these mirrors what latexmlmath produces, so that
+MathSymbol.tree_from_mathml() creates the same SLT from either source.
+Anything else raises UnsupportedLatexException, and the formula is passed on to LaTeXML.
+'''
+
+GREEK = {'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ', 'epsilon': 'ϵ', 'varepsilon': 'ε',
+         'zeta': 'ζ', 'eta': 'η', 'theta': 'θ', 'vartheta': 'ϑ', 'iota': 'ι', 'kappa': 'κ',
+         'lambda': 'λ', 'mu': 'μ', 'nu': 'ν', 'xi': 'ξ', 'pi': 'π', 'varpi': 'ϖ', 'rho': 'ρ',
+         'varrho': 'ϱ', 'sigma': 'σ', 'varsigma': 'ς', 'tau': 'τ', 'upsilon': 'υ', 'phi': 'ϕ',
+         'varphi': 'φ', 'chi': 'χ', 'psi': 'ψ', 'omega': 'ω',
+         'Gamma': 'Γ', 'Delta': 'Δ', 'Theta': 'Θ', 'Lambda': 'Λ', 'Xi': 'Ξ', 'Pi': 'Π',
+         'Sigma': 'Σ', 'Upsilon': 'Υ', 'Phi': 'Φ', 'Psi': 'Ψ', 'Omega': 'Ω',
+         'infty': '∞', 'ell': 'ℓ', 'emptyset': '∅', 'nabla': '∇'}
+OPERATORS = {'+': '+', '-': '−', '*': '∗', '/': '/', '=': '=', '<': '<', '>': '>', '!': '!',
+             ',': ',', ';': ';', ':': ':',
+             'cdot': '⋅', 'times': '×', 'div': '÷', 'pm': '±', 'mp': '∓', 'circ': '∘',
+             'leq': '≤', 'le': '≤', 'geq': '≥', 'ge': '≥', 'neq': '≠', 'ne': '≠',
+             'approx': '≈', 'equiv': '≡', 'sim': '∼', 'cong': '≅', 'propto': '∝',
+             'to': '→', 'rightarrow': '→', 'mapsto': '↦', 'Rightarrow': '⇒', 'implies': '⟹',
+             'Leftrightarrow': '⇔', 'iff': '⇔', 'in': '∈', 'notin': '∉', 'subset': '⊂',
+             'subseteq': '⊆', 'cup': '∪', 'cap': '∩', 'partial': '∂', 'forall': '∀', 'exists': '∃',
+             'sum': '∑', 'prod': '∏', 'int': '∫', 'oint': '∮', 'lim': 'lim'}
+FUNCTIONS = ['sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'sinh', 'cosh', 'tanh', 'log', 'ln', 'exp',
+             'det', 'gcd', 'max', 'min', 'arcsin', 'arccos', 'arctan']
+SPACES = ['', ',', ';', ':', '!', 'quad', 'qquad', 'displaystyle', 'textstyle', ' ']
+FENCES = {'(': ')', '[': ']'}
+MATRICES = {'matrix': ('', ''), 'pmatrix': ('(', ')'), 'bmatrix': ('[', ']'),
+            'Bmatrix': ('{', '}'), 'vmatrix': ('|', '|'), 'Vmatrix': ('∥', '∥')}
+DOUBLE_STRUCK = {'C': 'ℂ', 'H': 'ℍ', 'N': 'ℕ', 'P': 'ℙ', 'Q': 'ℚ', 'R': 'ℝ', 'Z': 'ℤ'}
+
+TOKEN = re.compile(r"\\([a-zA-Z]+|.)|(\d+(?:\.\d+)?)|(\s+)|(.)", re.DOTALL)
+
+
+class LatexToSLT(object):
+    """
+    Recursive descent parser for a common subset of LaTeX math,
+    falling back to LaTeXML (via LatexToMathML) for everything else
+    """
+    counts = Counter()  # number of formulas converted "native"ly and by "fallback"
+
+    def __init__(self, tex_query):
+        self.tokens = []
+        for m in TOKEN.finditer(tex_query):
+            if m.group(1) is not None:
+                if m.group(1) not in SPACES:
+                    self.tokens.append(('\\', m.group(1)))
+            elif m.group(2) is not None:
+                self.tokens.append(('n', m.group(2)))
+            elif m.group(3) is not None:
+                self.tokens.append(('s', m.group(3)))  # only significant within \text
+            else:
+                self.tokens.append(('c', m.group(4)))
+        self.pos = 0
+
+    @classmethod
+    def mathml_from_latex(cls, tex_query):
+        """
+        param tex_query: LaTeX formula (without surrounding $ signs)
+        return: Presentation MathML shaped like latexmlmath output
+        rtype:  Element
+        raises: UnsupportedLatexException if the formula uses LaTeX outside the supported subset
+        """
+        parser = cls(LatexToMathML.normalize(tex_query))
+        row = parser.expression(())
+        if parser.peek()[0] is not None:
+            raise UnsupportedLatexException(tex_query)
+        root = ET.Element(MathML.math, {'alttext': tex_query.strip()})
+        root.append(cls.mrow(row) if row else ET.Element(MathML.mrow))
+        return root
+
+    @classmethod
+    def tree_from_latex(cls, tex_query, fallback=True):
+        """
+        return: the SLT for a LaTeX formula, using LaTeXML only if the formula is not supported here
+        rtype:  MathSymbol
+        """
+        return MathSymbol.tree_from_mathml(cls.pmml_from_latex(tex_query, fallback))
+
+    @classmethod
+    def convert_to_mathml(cls, tex_query, fallback=True):
+        """
+        drop-in replacement for LatexToMathML.convert_to_mathml
+        """
+        return ET.tostring(cls.pmml_from_latex(tex_query, fallback), encoding="unicode")
+
+    @classmethod
+    def pmml_from_latex(cls, tex_query, fallback):
+        try:
+            pmml = cls.mathml_from_latex(tex_query)
+            cls.counts["native"] += 1
+        except UnsupportedLatexException:
+            if not fallback:
+                raise
+            cls.counts["fallback"] += 1
+            pmml = MathExtractor.isolate_mml(LatexToMathML.convert_to_mathml(tex_query))
+        return pmml
+
+    @classmethod
+    def report(cls, file=sys.stderr, counts=None):
+        """
+        print how many formulas were converted natively and by LaTeXML (counts, e.g., totalled over
+        worker processes, else those of this process)
+        """
+        counts = cls.counts if counts is None else counts
+        total = counts["native"] + counts["fallback"]
+        if total:
+            print("LaTeX formulas converted: %d natively, %d by LaTeXML (%.1f%% fallback)"
+                  % (counts["native"], counts["fallback"], 100.0 * counts["fallback"] / total), file=file)
+
+    """
+    ---------------------------------------------------
+        Building MathML elements
+    ---------------------------------------------------
+    """
+
+    @classmethod
+    def token(cls, tag, text, **attrib):
+        elem = ET.Element(MathML.namespace + tag, attrib)
+        elem.text = text
+        return elem
+
+    @classmethod
+    def mrow(cls, children):
+        if len(children) == 1:
+            return children[0]
+        row = ET.Element(MathML.mrow)
+        row.extend(children)
+        return row
+
+    @classmethod
+    def fenced(cls, opening, children, closing):
+        """
+        latexmlmath keeps comma-separated arguments flat, but groups any other fenced content
+        """
+        row = ET.Element(MathML.mrow)
+        if opening:
+            row.append(cls.token('mo', opening))
+        if any(child.tag == MathML.mo and child.text == ',' for child in children):
+            row.extend(children)
+        elif children:
+            row.append(cls.mrow(children))
+        if closing:
+            row.append(cls.token('mo', closing))
+        return row
+
+    """
+    ---------------------------------------------------
+        Parsing
+    ---------------------------------------------------
+    """
+
+    def peek(self):
+        while self.pos < len(self.tokens) and self.tokens[self.pos][0] == 's':
+            self.pos += 1
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            raise UnsupportedLatexException(str(token[1]))
+        self.pos += 1
+        return token
+
+    def expression(self, stops):
+        """
+        parse terms until a token in stops (or a closing brace, \\right, &, \\\\, or \\end) is reached
+        """
+        row = []
+        while True:
+            token = self.peek()
+            if token[0] is None or token in stops or token in [('c', '}'), ('\\', 'right'), ('c', '&'), ('\\', '\\'), ('\\', 'end')]:
+                return row
+            if token[0] == 'c' and token[1] in FENCES:
+                self.pos += 1
+                inner = self.expression((('c', FENCES[token[1]]),))
+                self.take('c', FENCES[token[1]])
+                row.append(self.scripts(self.fenced(token[1], inner, FENCES[token[1]])))
+            elif token == ('c', '{'):
+                row.append(self.scripts(self.group()))
+            elif token == ('\\', '{'):
+                self.pos += 1
+                inner = self.expression((('\\', '}'),))
+                self.take('\\', '}')
+                row.append(self.scripts(self.fenced('{', inner, '}')))
+            else:
+                row.append(self.scripts(self.atom()))
+
+    def group(self):
+        """
+        a braced group or a single atom, as used for arguments and scripts
+        """
+        token = self.peek()
+        if token == ('c', '{'):
+            self.pos += 1
+            row = self.expression(())
+            self.take('c', '}')
+            return self.mrow(row) if row else ET.Element(MathML.mrow)
+        if token[0] == 'n' and len(token[1]) > 1:  # TeX takes just one digit as an argument
+            self.tokens[self.pos:self.pos+1] = [('n', token[1][0]), ('n', token[1][1:])]
+        return self.atom()
+
+    def text_argument(self):
+        self.take('c', '{')
+        text = []
+        depth = 1
+        while True:
+            if self.pos >= len(self.tokens):
+                raise UnsupportedLatexException('{' + "".join(text))
+            token = self.tokens[self.pos]
+            self.pos += 1
+            if token == ('c', '{'):
+                depth += 1
+            elif token == ('c', '}'):
+                depth -= 1
+                if depth == 0:
+                    return "".join(text)
+            text.append(token[1] if token[0] != '\\' else '\\' + token[1])
+
+    def scripts(self, base):
+        sub = sup = None
+        while True:
+            token = self.peek()
+            if token == ('c', '_') and sub is None:
+                self.pos += 1
+                sub = self.group()
+            elif token == ('c', '^') and sup is None:
+                self.pos += 1
+                sup = self.group()
+            elif token == ('c', "'") and sup is None:
+                primes = 0
+                while self.peek() == ('c', "'"):
+                    self.pos += 1
+                    primes += 1
+                if primes > 3:
+                    raise UnsupportedLatexException("'" * primes)
+                sup = self.token('mo', '′″‴'[primes-1])
+            else:
+                break
+        if sub is not None and sup is not None:
+            elem = ET.Element(MathML.msubsup)
+            elem.extend([base, sub, sup])
+        elif sub is not None:
+            elem = ET.Element(MathML.msub)
+            elem.extend([base, sub])
+        elif sup is not None:
+            elem = ET.Element(MathML.msup)
+            elem.extend([base, sup])
+        else:
+            elem = base
+        return elem
+
+    def atom(self):
+        (kind, value) = self.take()
+        if kind == 'n':
+            return self.token('mn', value)
+        if kind == 'c':
+            if value.isalpha():
+                return self.token('mi', value)
+            if value in OPERATORS:
+                return self.token('mo', OPERATORS[value])
+            raise UnsupportedLatexException(value)
+        # control sequences
+        if value in GREEK:
+            return self.token('mi', GREEK[value])
+        if value in FUNCTIONS:
+            return self.token('mi', value)
+        if value in OPERATORS:
+            return self.token('mo', OPERATORS[value])
+        if value == '|':
+            return self.token('mo', '∥')
+        if value in ['frac', 'dfrac', 'tfrac']:
+            elem = ET.Element(MathML.mfrac)
+            elem.extend([self.group(), self.group()])
+            return elem
+        if value == 'sqrt':
+            if self.peek() == ('c', '['):
+                self.pos += 1
+                index = self.expression((('c', ']'),))
+                self.take('c', ']')
+                elem = ET.Element(MathML.mroot)
+                elem.extend([self.group(), self.mrow(index)])
+            else:
+                elem = ET.Element(MathML.msqrt)
+                elem.append(self.group())
+            return elem
+        if value == 'left':
+            opening = self.delimiter()
+            inner = self.expression(())
+            self.take('\\', 'right')
+            return self.fenced(opening, inner, self.delimiter())
+        if value == 'text':
+            return self.token('mtext', self.text_argument())
+        if value == 'mathbb':
+            letter = self.text_argument().strip()
+            if letter not in DOUBLE_STRUCK:
+                raise UnsupportedLatexException(value + letter)
+            return self.token('mi', DOUBLE_STRUCK[letter])
+        if value == 'mathrm':
+            name = self.text_argument().strip()
+            if not name.isalpha():
+                raise UnsupportedLatexException(value + name)
+            return self.token('mi', name, mathvariant='normal')
+        if value == 'qvar':
+            return ET.Element(MathML.mqvar, {'name': self.text_argument().strip()})
+        if value == 'begin':
+            return self.matrix()
+        raise UnsupportedLatexException('\\' + value)
+
+    def delimiter(self):
+        (kind, value) = self.take()
+        if value == '.':
+            return None
+        if kind == 'c' and value in '()[]|':
+            return value
+        if kind == '\\' and value in ['{', '}']:
+            return value
+        if kind == '\\' and value in ['|', 'Vert']:
+            return '∥'
+        raise UnsupportedLatexException(value)
+
+    def matrix(self):
+        environment = self.text_argument()
+        if environment not in MATRICES:
+            raise UnsupportedLatexException(environment)
+        rows = []
+        cells = []
+        while True:
+            cells.append(self.expression(()))
+            token = self.take()
+            if token == ('c', '&'):
+                continue
+            if token == ('\\', '\\') or token == ('\\', 'end'):
+                if any(cells) or len(cells) > 1:
+                    rows.append(cells)
+                cells = []
+                if token == ('\\', 'end'):
+                    break
+                continue
+            raise UnsupportedLatexException(token[1])
+        if self.text_argument() != environment:
+            raise UnsupportedLatexException(environment)
+        table = ET.Element(MathML.mtable)
+        for cells in rows:
+            tr = ET.SubElement(table, MathML.mtr)
+            for cell in cells:
+                td = ET.SubElement(tr, MathML.mtd)
+                if cell:
+                    td.append(self.mrow(cell))
+        (opening, closing) = MATRICES[environment]
+        if not opening:
+            return table
+        return self.fenced(opening, [table], closing)
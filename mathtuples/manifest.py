@@ -0,0 +1,99 @@
+"""
+    mathtuples
+    Manifest of converted documents, so that unchanged documents need not be converted again
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from importlib import metadata
+__author__ = 'FWTompa'
+
+COMMIT_EVERY = 1000  # documents stored between commits
+
+
+class Manifest(object):
+    """
+    Store, for each docid, the hash of the document's content, the fingerprint of the configuration
+    used to convert it, and the resulting output (in an sqlite file)
+
+    A later run that finds the same content and configuration reuses the stored output.
+    Documents that are no longer in the input are dropped by prune() at the end of a complete run.
+    """
+
+    def __init__(self, path, options):
+        """
+        param path: sqlite file holding the manifest (created if need be)
+        type  path: string
+
+        param options: everything that affects the output (e.g., the keyword arguments given to parse_file)
+        type  options: dict
+        """
+        self.config = self.fingerprint(options)
+        self.run = time.time_ns()  # marks the documents seen in this run
+        self.reused = 0
+        self.converted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents "
+                        "(docid TEXT PRIMARY KEY, digest TEXT, config TEXT, output BLOB, run INTEGER)")
+        self.db.commit()
+
+    @classmethod
+    def fingerprint(cls, options):
+        """
+        return: hash of the configuration (incl. the version of mathtuples)
+        rtype:  string
+        """
+        try:
+            version = metadata.version("mathtuples")
+        except metadata.PackageNotFoundError:
+            version = ""
+        config = json.dumps({"version": version, "options": options}, sort_keys=True, default=str)
+        return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def digest(cls, content):
+        return hashlib.blake2b(content, digest_size=20).hexdigest()
+
+    def lookup(self, docid, digest):
+        """
+        return: the output stored for this document if its content and the configuration are unchanged, else None
+        rtype:  bytes
+        """
+        row = self.db.execute("SELECT output FROM documents WHERE docid = ? AND digest = ? AND config = ?",
+                              (docid, digest, self.config)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE documents SET run = ? WHERE docid = ?", (self.run, docid))
+        self.reused += 1
+        return row[0]
+
+    def store(self, docid, digest, output):
+        self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                        (docid, digest, self.config, output, self.run))
+        self.converted += 1
+        if self.converted % COMMIT_EVERY == 0:
+            self.db.commit()
+
+    def prune(self):
+        """
+        drop the documents not seen in this run
+
+        return: number of documents dropped
+        rtype:  int
+        """
+        dropped = self.db.execute("DELETE FROM documents WHERE run != ?", (self.run,)).rowcount
+        self.db.commit()
+        return dropped
+
+    def close(self):
+        if self.db:
+            self.db.commit()
+            self.db.close()
+            self.db = None
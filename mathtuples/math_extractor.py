@@ -28,6 +28,7 @@
 import sys
 import re
 import string
+from bisect import bisect_left
 import io
 import xml
 import os
@@ -38,6 +39,7 @@ import xml.etree.ElementTree as ET
 from sys import stderr
 
 from .mathsymbol import MathSymbol
+from .mathml import MathML
 from .symboltree import SymbolTree
 from .exceptions import UnknownTagException
 from .utility import uprint
@@ -64,6 +66,12 @@ class MathExtractor:
     math_pattern = re.compile(math_expr, re.DOTALL)  # does not allow for LaTeX
 
     open_tag = re.compile("<(?!/)(?!mws:qvar)"+namespace, re.DOTALL) # up to and including namespace
+
+    # math_pattern can take quadratic time (e.g., on many unclosed math elements), so math_spans() scans instead:
+    # it accepts the same tags, except that it does not allow < within a namespace prefix or an attribute value
+    math_open = re.compile(r"<((?:[^<>=\s:]*:)?[Mm]ath)(?=[\s>])")
+    math_attr = re.compile(r"\s+((?:[^<>=\s:]*:)?)([^<>=\s:]+)=(?:\"[^\"<]+\"|'[^'<]+')")
+    math_close = re.compile(r"</((?:[^<>=\s:]*:)?[Mm]ath)>")
     close_tag = re.compile("</(?!mws:qvar)"+namespace, re.DOTALL)    # but keep qvar namespace
 
     @classmethod
@@ -85,34 +93,161 @@ class MathExtractor:
                 N.B. All namespaces are removed
         """
 
-        if in_context:
-            pieces = cls.math_pattern.split(content)  # include surrounding text
-            contexts = pieces[0::4] # each math piece uses 3 slots
-            # print("Number of contexts detected: "+ str(len(contexts)))
-        exprs = cls.math_pattern.findall(content) # just the math expressions
-        # print("Number of formulas detected: "+ str(len(exprs)))
-        math = []
-
-        for (math_expr,QName,formula_id) in exprs:
-            # print("Math expression = ",math_expr.encode("utf-8"),file=stderr)
-           
+        return list(cls.iter_math_tokens(content, in_context, with_id))
+
+    @classmethod
+    def iter_math_tokens(cls, content, in_context=False, with_id=False):
+        """
+        extract Math expressions from XML (incl. HTML) file in a single pass, one at a time
+
+        params: as for math_tokens
+
+        return: embedded math expressions (interleaved with the surrounding text if in_context)
+        rtype:  iterator of strings, in the same order as the list returned by math_tokens
+        """
+        pos = 0
+        for (start, end, QName, formula_id) in cls.math_spans(content):
+            if in_context:
+                yield content[pos:start] # include surrounding text
+            math_expr = content[start:end]
             # assert: math_expr.endswith("ath>"): # MathML token
             math_expr = cls.close_tag.sub("</",math_expr) # drop namespaces (FWT)
             math_expr = cls.open_tag.sub("<",math_expr)
             math_expr = math_expr.replace("<Math ","<math ").replace("</Math>","</math>")
-            # print("Revised token = ",math_expr,file=stderr)
-            # print("id = "+formula_id,file=stderr)
             if with_id:
-                math.append(formula_id)
-            math.append(math_expr)
-                
+                yield formula_id
+            yield math_expr
+            pos = end
         if in_context:
-            pieces = contexts + math # make a list of the right length
-            pieces[::2] = contexts
-            pieces[1::2] = math
-            return pieces
-        else:
-            return math
+            yield content[pos:]
+
+    @classmethod
+    def math_spans(cls, content):
+        """
+        find the math expressions in XML (incl. HTML), as math_pattern would, but in linear time
+
+        param content: XML document
+        type  content: string
+
+        return: start and end offsets, QName, and id attribute (with its leading space, or "") of each math expression
+        rtype:  iterator of (int, int, string, string)
+        """
+        closes = None    # offsets of the closing tags for each QName, indexed once the first math element is found
+        pos = 0
+        while True:
+            opened = cls.math_open.search(content, pos)
+            if not opened:
+                return
+            pos = opened.end()
+            QName = opened.group(1)
+            formula_id = ""
+            ids = 0
+            i = opened.end()
+            while not content.startswith(">", i):  # parse attributes up to the end of the tag
+                attr = cls.math_attr.match(content, i)
+                if not attr:
+                    break
+                if attr.group(1) == "" and attr.group(2) == "id":
+                    formula_id = attr.group(0)
+                    ids += 1
+                i = attr.end()
+            if not content.startswith(">", i) or ids > 1:
+                continue
+            if closes is None:
+                closes = {}
+                for closed in cls.math_close.finditer(content):
+                    closes.setdefault(closed.group(1), []).append(closed.start())
+            ends = closes.get(QName, [])
+            n = bisect_left(ends, i + 1)
+            if n == len(ends):
+                continue
+            pos = ends[n] + len(QName) + 3  # after </QName>
+            yield (opened.start(), pos, QName, formula_id)
+
+    @classmethod
+    def math_elements(cls, source, id_tag=None):
+        """
+        extract Math expressions from a well-formed XML (incl. XHTML) file in a single incremental parse
+
+        param source: XML document
+        type  source: file name or binary file object
+        param (id_tag): local name of the element whose text identifies the current document
+        type  (id_tag): string
+
+        return: embedded math expressions, each with the current document id and its ordinal in that document
+        rtype:  iterator of (string, int, Element)
+                N.B. All namespaces except that of mws:qvar are removed, as for math_tokens
+        """
+        mathID = ""
+        ordinal = 0
+        for elem in cls.outermost_elements(source, ["math", "Math", id_tag]):
+            if cls.local_name(elem.tag) == id_tag:
+                mathID = (elem.text or "").strip()
+                ordinal = 0
+            else:
+                ordinal += 1
+                cls.strip_namespaces(elem)
+                yield (mathID, ordinal, elem)
+
+    @classmethod
+    def records(cls, source, tag, id_attr="Id", body_attr="Body"):
+        """
+        stream the records of a (possibly huge) XML file, such as the rows of a Posts.xml dump
+
+        param source: XML document
+        type  source: file name or binary file object
+        param tag: local name of each record element
+        type  tag: string
+        param (id_attr): attribute holding the record id
+        type  (id_attr): string
+        param (body_attr): attribute holding the (unescaped) record body, or else the record's text is used
+        type  (body_attr): string
+
+        return: id and body of each record
+        rtype:  iterator of (string, string)
+        """
+        for elem in cls.outermost_elements(source, [tag]):
+            if body_attr in elem.attrib:
+                body = elem.attrib[body_attr]
+            else:
+                body = "".join(elem.itertext())
+            yield (elem.get(id_attr, ""), body)
+
+    @classmethod
+    def outermost_elements(cls, source, names):
+        """
+        incrementally parse source, yielding each outermost element with a local name in names once it is complete;
+        everything else is released once parsed, so memory use does not grow with the size of the file
+        (a yielded element is released when the next one is requested)
+        """
+        stack = []  # open elements
+        wanted = None # outermost open element with a wanted name
+        for (event, elem) in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                if wanted is None and cls.local_name(elem.tag) in names:
+                    wanted = elem
+                continue
+            stack.pop()
+            if elem is wanted:
+                wanted = None
+                yield elem
+            elif wanted is not None:
+                continue  # still part of the wanted element
+            if stack:
+                stack[-1].remove(elem)
+            elem.clear()
+
+    @classmethod
+    def local_name(cls, tag):
+        return tag[tag.find("}")+1:]
+
+    @classmethod
+    def strip_namespaces(cls, math_root):
+        for elem in math_root.iter():
+            if elem.tag.startswith("{") and elem.tag != MathML.mqvar:
+                elem.tag = cls.local_name(elem.tag)
+        math_root.tag = "math"
 
     '''
     as produced by LaTeXML:
@@ -156,7 +291,7 @@ class MathExtractor:
         extract the desired form of MathML from an MathML expr
         
         param math_expr: MathML expression
-        type  math_expr: string surrounded by "<math ...</math>"
+        type  math_expr: string surrounded by "<math ...</math>" or Element (modified in place)
         param wants_cmml: flag to indicate whether Content (as opposed to Presentation) desired
         type  wants_cmml: boolean
         return: Presentation MathML (default) or Content MathML
@@ -166,7 +301,7 @@ class MathExtractor:
             return None
         #print("MathML: " + math_expr)
         
-        math_root = ET.fromstring(math_expr)
+        math_root = ET.fromstring(math_expr) if isinstance(math_expr, str) else math_expr
 ##        print("isolate_" + (wants_cmml if "cmml" else "pmml") + " math_expr: " + ET.tostring(xml_root,encoding="unicode"))
 
         tex_parent=math_root.find(".//annotation[@encoding='application/x-tex']/..")
@@ -0,0 +1,127 @@
+"""
+    mathtuples
+    Buffered output of math tuples as bytes
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import os
+from .streams import open_output
+__author__ = 'FWTompa'
+
+ENCODING = "utf-8"
+BUFFER_SIZE = 1 << 20  # bytes held before writing
+MAX_IOV = 1024         # most chunks handed to one os.writev call
+
+
+class OutputSink(object):
+    """
+    Collect output text as encoded chunks (one per formula or context fragment) and write them in large blocks
+
+    The sink can stand in for a text file (write() takes strings, so print(..., file=sink) also works),
+    and write_bytes() takes text that is already encoded (e.g., context copied from memory-mapped input).
+    With writev, the chunks are handed to the operating system as they are rather than first being joined.
+    """
+
+    def __init__(self, stream, buffer_size=BUFFER_SIZE, writev=False):
+        """
+        param stream: binary stream (e.g., sys.stdout.buffer) or the name of a file to create (compressed if .gz, .bz2, or .xz)
+        type  stream: file object or string
+
+        param (buffer_size): bytes to collect before writing (0 => write every chunk at once)
+        type  (buffer_size): int
+
+        param (writev): whether to write the collected chunks with os.writev (if the stream has a file descriptor)
+        type  (writev): boolean
+        """
+        self.owned = isinstance(stream, str)
+        self.stream = open_output(stream) if self.owned else stream
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.pending = 0
+        self.written = 0  # bytes flushed to the stream so far
+        self.chars = None  # characters output so far, once count_chars() is called
+        self.fd = None
+        if writev and hasattr(os, "writev"):
+            try:
+                self.fd = self.stream.fileno()
+            except (AttributeError, OSError, ValueError):
+                self.fd = None
+
+    def count_chars(self):
+        """
+        start counting the characters output (as well as the bytes)
+        """
+        if self.chars is None:
+            self.chars = 0
+
+    def write(self, text):
+        if text:
+            if self.chars is not None:
+                self.chars += len(text)
+            self.add_chunk(text.encode(ENCODING, "surrogateescape"))  # undecodable input bytes are copied as read
+        return len(text)
+
+    def write_bytes(self, data):
+        if data:
+            if self.chars is not None:
+                self.chars += len(data.decode(ENCODING, "surrogateescape"))
+            self.add_chunk(data)
+
+    def add_chunk(self, data):
+        if data:
+            self.chunks.append(data)
+            self.pending += len(data)
+            if self.pending >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        if self.chunks:
+            if self.fd is None:
+                self.stream.write(b"".join(self.chunks))
+            else:
+                self.stream.flush()  # anything written to the stream directly goes first
+                self.writev(self.chunks)
+            self.written += self.pending
+            self.chunks = []
+            self.pending = 0
+        self.stream.flush()
+
+    def writev(self, chunks):
+        for i in range(0, len(chunks), MAX_IOV):
+            batch = chunks[i:i + MAX_IOV]
+            remaining = sum(len(chunk) for chunk in batch)
+            while remaining > 0:
+                done = os.writev(self.fd, batch)
+                remaining -= done
+                while batch and done >= len(batch[0]):  # drop what was written, keeping any partial chunk
+                    done -= len(batch[0])
+                    batch.pop(0)
+                if done:
+                    batch[0] = batch[0][done:]
+
+    def tell(self):
+        """
+        return: bytes output so far, including those not yet flushed
+        rtype:  int
+        """
+        return self.written + self.pending
+
+    def close(self):
+        """
+        flush the output, closing the stream only if the sink opened it
+        """
+        if self.stream is not None:
+            self.flush()
+            if self.owned:
+                self.stream.close()
+                self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
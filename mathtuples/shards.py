@@ -0,0 +1,251 @@
+"""
+    mathtuples
+    Driver that converts an input file in shards, split at document boundaries, and merges the results
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+__author__ = 'FWTompa'
+
+MANIFEST = "manifest.json"
+ENCODING = "utf-8"
+
+
+def shard_ranges(infile, shards, docid="<DOCNO>"):
+    """
+    split a file into byte ranges of about equal size, each but the first starting on a line holding a docid
+
+    return: (start, end) for each shard, end exclusive; fewer than shards if there are too few documents
+    rtype:  list of (int, int)
+    """
+    size = os.path.getsize(infile)
+    idRE = re.compile(docid.encode(ENCODING) + rb"([^ <>]*)")
+    starts = [0]
+    with open(infile, "rb") as fin:
+        for i in range(1, shards):
+            start = document_start(fin, max(size * i // shards, starts[-1] + 1), idRE)
+            if start is None:
+                break
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+def document_start(fin, target, idRE):
+    """
+    return: offset of the first line starting at or after target that holds a docid (None if there is none)
+    rtype:  int
+    """
+    fin.seek(target - 1)
+    fin.readline()  # to the end of the line holding byte target - 1
+    while True:
+        start = fin.tell()
+        line = fin.readline()
+        if not line:
+            return None
+        if idRE.search(line):
+            return start
+
+def partial_name(output):
+    """
+    return: name under which a shard's output is written until it is complete, keeping its extension
+            (e.g., shard-00000.partial.gz), which tells mathtuples.convert whether to compress it
+    rtype:  string
+    """
+    (root, ext) = os.path.splitext(output)
+    return root + ".partial" + ext
+
+def shard_command(infile, start, end, output, docid, convert_args):
+    """
+    return: command converting bytes start to end of infile into output
+    rtype:  list of strings
+    """
+    return ([sys.executable, "-m", "mathtuples.convert", "-infile", infile, "--range", "%d:%d" % (start, end),
+             "-outfile", output, "-docid", docid] + convert_args)
+
+
+class ShardRun(object):
+    """
+    Convert the shards of an input file (in parallel, locally or through a launcher), recording their progress
+    in a manifest in the output directory, from which failed shards can be retried and the outputs merged in order
+    """
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.path = os.path.join(outdir, MANIFEST)
+        self.lock = threading.RLock()  # held while the manifest is changed or saved
+        self.manifest = None
+
+    def plan(self, infile, shards, docid="<DOCNO>", convert_args=[], suffix=".out"):
+        """
+        split infile into shards and start a new manifest (replacing any earlier one)
+        """
+        os.makedirs(self.outdir, exist_ok=True)
+        infile = os.path.abspath(infile)
+        self.manifest = {"infile": infile,
+                         "size": os.path.getsize(infile),
+                         "mtime": os.path.getmtime(infile),
+                         "docid": docid,
+                         "convert_args": convert_args,
+                         "shards": [{"shard": i, "start": start, "end": end,
+                                     "output": "shard-%05d%s" % (i, suffix),
+                                     "status": "pending", "attempts": 0}
+                                    for (i, (start, end)) in enumerate(shard_ranges(infile, shards, docid))]}
+        self.save()
+        return self.manifest
+
+    def load(self):
+        """
+        read the manifest of an earlier run, checking that its input file has not changed since
+        """
+        with open(self.path) as f:
+            self.manifest = json.load(f)
+        infile = self.manifest["infile"]
+        if (os.path.getsize(infile), os.path.getmtime(infile)) != (self.manifest["size"], self.manifest["mtime"]):
+            raise ValueError(infile + " has changed since the shards in " + self.path + " were planned")
+        return self.manifest
+
+    def save(self):
+        """
+        write the manifest, replacing the previous one only once it is complete
+        """
+        with self.lock:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.manifest, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+
+    def update(self, shard, **fields):
+        """
+        change fields of a shard and save the manifest, so that no other thread saves it half changed
+        """
+        with self.lock:
+            shard.update(fields)
+            self.save()
+
+    def run(self, jobs=1, launcher=None, attempts=1):
+        """
+        convert every shard not yet done, jobs at a time, each up to attempts times
+
+        param (launcher): shell command to run each shard, in which {command} is replaced by the conversion command
+                          and {shard} by the shard number (e.g., "ssh node{shard} {command}"); None => run locally
+        type  (launcher): string
+
+        return: whether all shards are done
+        rtype:  boolean
+        """
+        todo = [shard for shard in self.manifest["shards"] if shard["status"] != "done"]
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(lambda shard: self.run_shard(shard, launcher, attempts), todo))
+        return self.done()
+
+    def run_shard(self, shard, launcher, attempts):
+        output = os.path.join(self.outdir, shard["output"])
+        partial = partial_name(output)
+        command = shard_command(self.manifest["infile"], shard["start"], shard["end"], partial,
+                                self.manifest["docid"], self.manifest["convert_args"])
+        if launcher:
+            command = launcher.replace("{command}", shlex.join(command)).replace("{shard}", str(shard["shard"]))
+        for attempt in range(attempts):
+            self.update(shard, attempts=shard["attempts"] + 1, status="running")
+            with open(output + ".log", "w") as log:
+                code = subprocess.call(command, shell=bool(launcher), stdout=log, stderr=log)
+            if code == 0 and os.path.exists(partial):
+                os.replace(partial, output)
+                self.update(shard, status="done", output_bytes=os.path.getsize(output))
+                print("shard %d (bytes %d:%d) done" % (shard["shard"], shard["start"], shard["end"]), file=sys.stderr)
+                return True
+            self.update(shard, status="failed")
+            print("shard %d (bytes %d:%d) failed with exit code %d; see %s" % (shard["shard"], shard["start"], shard["end"],
+                  code, output + ".log"), file=sys.stderr)
+        return False
+
+    def done(self):
+        return all(shard["status"] == "done" for shard in self.manifest["shards"])
+
+    def merge(self, outfile):
+        """
+        concatenate the shards' outputs in order (compressed outputs remain valid, as multi-stream files)
+        """
+        if not self.done():
+            raise ValueError("not all shards in " + self.path + " are done")
+        with open(outfile, "wb") as fout:
+            for shard in self.manifest["shards"]:
+                with open(os.path.join(self.outdir, shard["output"]), "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+
+
+if __name__ == '__main__':
+    descp = "Shards - convert an input file in shards split at document boundaries"
+    epilog = '''Options not listed here (e.g., -c or -s) are passed to every mathtuples.convert shard.
+    '''
+    parser = argparse.ArgumentParser(description=descp, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-infile', '--infile',
+                        dest="infile",
+                        help="The (uncompressed) file to convert; needed unless retrying",
+                        default=None)
+    parser.add_argument("-o", '--outdir',
+                        dest="outdir",
+                        help="Directory for the shards' outputs, logs, and manifest",
+                        required=True)
+    parser.add_argument("-n", '--shards',
+                        dest="shards",
+                        help="Number of shards; default = 4",
+                        default=4,
+                        type=int)
+    parser.add_argument("-j", '--jobs',
+                        dest="jobs",
+                        help="Number of shards converted at a time; default = number of shards",
+                        default=0,
+                        type=int)
+    parser.add_argument("-docid", '--docid',
+                        dest="docid",
+                        help="String preceding each document identifier, at which shards may start; default = <DOCNO>",
+                        default="<DOCNO>")
+    parser.add_argument('--suffix',
+                        dest="suffix",
+                        help="Suffix of each shard's output file (e.g., .gz to compress it); default = .out",
+                        default=".out")
+    parser.add_argument('--launcher',
+                        dest="launcher",
+                        help="Shell command running each shard, with {command} and {shard} filled in; default => run locally",
+                        default=None)
+    parser.add_argument('--attempts',
+                        dest="attempts",
+                        help="Times to try each shard before giving up; default = 1",
+                        default=1,
+                        type=int)
+    parser.add_argument('--retry',
+                        dest="retry",
+                        action="store_true",
+                        help="Rerun only the shards of the existing manifest that are not done",
+                        default=False)
+    parser.add_argument('--merge',
+                        dest="merge",
+                        help="Once all shards are done, concatenate their outputs in order into this file",
+                        default=None)
+    (args, convert_args) = parser.parse_known_args()
+    run = ShardRun(args.outdir)
+    try:
+        if args.retry:
+            run.load()
+        elif args.infile:
+            run.plan(args.infile, args.shards, docid=args.docid, convert_args=convert_args, suffix=args.suffix)
+        else:
+            parser.error("-infile is needed unless retrying")
+    except (OSError, ValueError) as err:
+        parser.error(str(err))
+    done = run.run(jobs=args.jobs or len(run.manifest["shards"]), launcher=args.launcher, attempts=args.attempts)
+    if done and args.merge:
+        run.merge(args.merge)
+    sys.exit(0 if done else 1)
@@ -0,0 +1,73 @@
+"""
+    mathtuples
+    Sidecar of the spans of formulas in the input and of their tuples in the output (in context)
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+from .math_extractor import MathExtractor
+from .output import OutputSink
+__author__ = 'FWTompa'
+
+ENCODING = "utf-8"
+COLUMNS = ["docid", "ordinal",
+           "input_char_start", "input_char_end", "input_byte_start", "input_byte_end",
+           "output_char_start", "output_char_end", "output_byte_start", "output_byte_end"]
+
+
+class FormulaSpans(object):
+    """
+    Record, for each math expression converted in context, where it lies in the input and where its tuples lie
+    in the output, as character and byte spans (start inclusive, end exclusive) relative to the start of its document
+    in each, one tab-separated line per math expression (numbered from 1 within its document, as in a FormulaIndex)
+    """
+
+    def __init__(self, name):
+        """
+        param name: file to create for the spans (compressed if .gz, .bz2, or .xz)
+        type  name: string
+        """
+        self.sink = OutputSink(name)
+        self.sink.write("\t".join(COLUMNS) + "\n")
+        self.ordinals = {}  # last ordinal for each docid
+        self.bases = (0, 0, 0, 0)  # input chars and bytes, and output chars and bytes, preceding the current document
+
+    def start_document(self, chars, offset, fout):
+        """
+        start a document after this many characters and bytes of input, and the output so far to fout
+        """
+        fout.count_chars()
+        self.bases = (chars, offset, fout.chars, fout.tell())
+
+    def input_spans(self, content, chars, offset):
+        """
+        return: character and byte spans of the math expressions in content, which starts after chars characters
+                and offset bytes of input
+        rtype:  list of (int, int, int, int)
+        """
+        spans = []
+        (char_pos, byte_pos) = (0, offset)
+        for (start, end, QName, formula_id) in MathExtractor.math_spans(content):
+            byte_pos += len(content[char_pos:start].encode(ENCODING, "surrogateescape"))
+            length = len(content[start:end].encode(ENCODING, "surrogateescape"))
+            spans.append((chars + start, chars + end, byte_pos, byte_pos + length))
+            (char_pos, byte_pos) = (end, byte_pos + length)
+        return spans
+
+    def add(self, docid, input_span, output_start, fout):
+        """
+        record a math expression found at input_span, whose tuples were written to fout from output_start (chars, bytes)
+        """
+        ordinal = self.ordinals.get(docid, 0) + 1
+        self.ordinals[docid] = ordinal
+        (in_chars, in_bytes, out_chars, out_bytes) = self.bases
+        (char_start, char_end, byte_start, byte_end) = input_span
+        self.sink.write("%s\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\n" % (docid, ordinal,
+                        char_start - in_chars, char_end - in_chars, byte_start - in_bytes, byte_end - in_bytes,
+                        output_start[0] - out_chars, fout.chars - out_chars, output_start[1] - out_bytes, fout.tell() - out_bytes))
+
+    def close(self):
+        self.sink.close()
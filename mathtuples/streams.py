@@ -0,0 +1,202 @@
+"""
+    mathtuples
+    Input and output files, compressed according to their extensions
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import threading
+__author__ = 'FWTompa'
+
+ENCODING = "utf-8"
+CODECS = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+BLOCK_SIZE = 1 << 20  # bytes (de)compressed at a time
+QUEUE_BLOCKS = 8      # blocks waiting between the codec thread and the converter
+
+
+def codec(name):
+    """
+    return: the module that (de)compresses the named file, or None if its extension is not that of a compressed file
+    rtype:  module
+    """
+    for (extension, module) in CODECS.items():
+        if name.endswith(extension):
+            return module
+    return None
+
+def open_input(name):
+    """
+    open a file for reading as bytes, decompressing it in a background thread if its name so indicates
+    """
+    module = codec(name)
+    if module is None:
+        return open(name, "rb")
+    return io.BufferedReader(ReadAhead(module.open(name, "rb")), buffer_size=BLOCK_SIZE)
+
+def open_output(name):
+    """
+    open a file for writing as bytes, compressing it in a background thread if its name so indicates
+    """
+    module = codec(name)
+    if module is None:
+        return open(name, "wb")
+    return io.BufferedWriter(WriteBehind(module.open(name, "wb")), buffer_size=BLOCK_SIZE)
+
+def open_range(name, start, end):
+    """
+    open bytes start to end (exclusive) of an uncompressed file for reading
+    """
+    source = open(name, "rb", buffering=0)
+    source.seek(start)
+    return io.BufferedReader(RangeReader(source, end - start), buffer_size=BLOCK_SIZE)
+
+def skip(stream, offset):
+    """
+    move past the first offset bytes of a binary stream, reading them if it cannot seek (e.g., if decompressed)
+    """
+    if stream.seekable():
+        stream.seek(offset)
+        return
+    remaining = offset
+    while remaining > 0:
+        block = stream.read(min(remaining, BLOCK_SIZE))
+        if not block:
+            raise EOFError("input ends before byte " + str(offset))
+        remaining -= len(block)
+
+def text_input(stream):
+    """
+    read a binary stream as text, as sys.stdin is read (lines end at \\n, and undecodable bytes are kept)
+    """
+    return io.TextIOWrapper(stream, encoding=ENCODING, errors="surrogateescape", newline="\n")
+
+
+class ReadAhead(io.RawIOBase):
+    """
+    Raw stream of the blocks read from a (decompressing) file by a background thread
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.block = b""
+        self.offset = 0  # bytes of block already read
+        self.error = None
+        self.finished = False
+        self.reader = threading.Thread(target=self.read_ahead, daemon=True)
+        self.reader.start()
+
+    def read_ahead(self):
+        try:
+            while not self.finished:
+                block = self.source.read(BLOCK_SIZE)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except Exception as err:
+            self.error = err
+            self.blocks.put(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.block):
+            if self.finished:
+                return 0
+            self.block = self.blocks.get()
+            self.offset = 0
+            if not self.block:
+                self.finished = True
+                if self.error:
+                    raise self.error
+        size = min(len(buffer), len(self.block) - self.offset)
+        buffer[:size] = memoryview(self.block)[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.finished = True
+            while self.reader.is_alive():  # let the reader finish putting its block
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.source.close()
+        super().close()
+
+
+class WriteBehind(io.RawIOBase):
+    """
+    Raw stream whose blocks are written to a (compressing) file by a background thread
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.error = None
+        self.writer = threading.Thread(target=self.write_behind, daemon=True)
+        self.writer.start()
+
+    def write_behind(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if self.error is None:
+                try:
+                    self.target.write(block)
+                except Exception as err:
+                    self.error = err
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.blocks.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.blocks.put(None)
+            self.writer.join()
+            self.target.close()
+            if self.error:
+                raise self.error
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Raw stream of (at most) the next length bytes of a file
+    """
+
+    def __init__(self, source, length):
+        self.source = source
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        size = self.source.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
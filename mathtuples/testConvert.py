@@ -30,7 +30,16 @@ Project: Tangent
 Purpose: To test the conversion of mathml to Tangent Tuples
 '''
 import unittest
+import contextlib
+import gzip
+import io
 import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 WINDOWS = "nt"
 ROOTPATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -39,12 +48,26 @@ from .convert import convert_math_expression,\
                                 determine_node,\
                                 expand_nodes_with_location,\
                                 expand_node_with_wildcards,\
-                                EDGE_PAIR_NODE, COMPOUND_NODE, \
-                                EOL_NODE, TERMINAL_NODE, SYMBOL_PAIR_NODE,\
-                                DUPLICATE_NODE, LONG_NODE, ABBREVIATED_NODE,\
-                                WILDCARD_MOCK, START_TAG, END_TAG,\
-                                INFINITE_DEPTH, MAX_EOL_HEIGHT, MAX_DUP
+                                COMPOUND_NODE, TERMINAL_NODE, SYMBOL_PAIR_NODE,\
+                                DUPLICATE_NODE, WILDCARD_MOCK, START_TAG, END_TAG,\
+                                INFINITE_DEPTH
+from .convert import trivial_math, TRIVIAL_TUPLES
 from .mathsymbol import REP_TAG
+from .math_extractor import MathExtractor
+from .output import OutputSink
+from .streams import open_input
+from .checkpoint import Checkpoint
+from .convert import parse_file, parse_documents, convert_indexed_formula, parse_xml_file, parse_records_file,\
+                      parse_mapped_file
+from .formula_index import FormulaIndex
+from .spans import FormulaSpans
+from .shards import shard_ranges, ShardRun
+from .manifest import Manifest
+from .workers import WorkerPool, RecyclingPool, run_task
+from .convert import convert_math_query, STAGES
+from .convert import convert_formula, formula_cost, line_spans, parse_formula_file, parse_shared_formula_file
+from .latex_mml import LatexToMathML
+from .testLatex import FakeLatexML
 
 def convert_test(mathml,
                synonyms=False,
@@ -961,6 +984,545 @@ class TestRandomEquation(TestBase):
         self.log(results)
         self.assertEqual(" ".join(expect), results)
 
+class TestTrivial(TestBase):
+    def setUp(self):
+        self.debug = True
+        TRIVIAL_TUPLES.clear()
+
+    def testRecognized(self):
+        self.assertEqual(trivial_math('<math display="inline"><mi>x</mi></math>'), "<math><mi>x</mi></math>")
+        self.assertEqual(trivial_math('<math><mrow> <mn>2</mn> </mrow></math>'), "<math><mrow><mn>2</mn></mrow></math>")
+        self.assertEqual(trivial_math('<math><msup><mi>x</mi><mn>2</mn></msup></math>'),
+                         "<math><msup><mi>x</mi><mn>2</mn></msup></math>")
+        self.assertIsNone(trivial_math('<math><mi>x</mi><mo>+</mo><mn>1</mn></math>'))
+        self.assertIsNone(trivial_math('<math><mrow><mi>x</mi></math>'))
+
+    def testSameAsFullConversion(self):
+        for mathml in ['<math><mi>x</mi></math>', '<math><msub><mo>∑</mo><mi>i</mi></msub></math>']:
+            full = convert_test(mathml, loc_info = {SYMBOL_PAIR_NODE: 8, TERMINAL_NODE: 8}, synonyms = True)
+            self.assertEqual(1, len(TRIVIAL_TUPLES))
+            fast = convert_test(mathml, loc_info = {SYMBOL_PAIR_NODE: 8, TERMINAL_NODE: 8}, synonyms = True)
+            self.assertEqual(full, fast)
+            TRIVIAL_TUPLES.clear()
+        self.assertEqual(" ".join([START_TAG, "#(v!x,!0)#", "#(v!x,!0,-)#", END_TAG]),
+                         convert_test('<math><mi>x</mi></math>', loc_info = {TERMINAL_NODE: 8}))
+
+    def testCorpus(self):
+        # the formulas for k in 02459.html, with LaTeXML's namespace, ids, and annotations
+        corpus = re.findall(r"<math.*?</math>", self.loadFile(os.path.join(ROOTPATH, "testFiles", "02459.html")), re.DOTALL)
+        mathml = [m for m in corpus if 'alttext="{\\displaystyle k}"' in m][0]
+        other = mathml.replace('id="math.2459.4', 'id="math.1.1')
+        self.assertNotEqual(mathml, other)
+        self.assertEqual(trivial_math(mathml), trivial_math(other))
+        self.assertIn('xmlns="http://www.w3.org/1998/Math/MathML"><semantics><mi>k</mi>', trivial_math(mathml))
+        full = convert_test(other)
+        TRIVIAL_TUPLES.clear()
+        convert_test(mathml)
+        self.assertEqual(1, len(TRIVIAL_TUPLES))
+        self.assertEqual(full, convert_test(other))
+
+class TestLimits(TestBase):
+    mathml = "<math><mi>x</mi><mo>+</mo><mi>y</mi><mo>+</mo><mi>x</mi><mo>=</mo><mn>2</mn></math>"
+    options = {"synonyms": True, "dups": "V", "loc_info": {SYMBOL_PAIR_NODE: 99, DUPLICATE_NODE: 99}}
+
+    def convert(self, **limits):
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            tuples = convert_math_expression("test", 1, self.mathml, limits=limits, **self.options).split()
+        return (tuples, err.getvalue())
+
+    def testWithinLimits(self):
+        (tuples, err) = self.convert(tuples=1000, nodes=100, bytes=1000)
+        self.assertEqual(convert_math_expression("test", 1, self.mathml, **self.options).split(), tuples)
+        self.assertEqual("", err)
+
+    def testDegradation(self):
+        (full, err) = self.convert()
+        (tuples, err) = self.convert(tuples=len(full) - 3)
+        self.assertIn("(tuples %d > %d): dropped locations\n" % (len(full) - 2, len(full) - 3), err)
+        self.assertTrue(set(tuples) < set(full))
+        (fewest, err) = self.convert(nodes=3)
+        self.assertIn("dropped locations, synonyms, duplicates\n", err)
+        self.assertTrue(set(fewest) < set(tuples))
+        self.assertFalse(any(t.startswith("#{") or "*" in t for t in fewest))
+        (tuples, err) = self.convert(tuples=1)
+        self.assertEqual(fewest, tuples)
+        self.assertIn("; still tuples", err)
+
+    def testBytes(self):
+        (tuples, err) = self.convert(bytes=len(self.mathml) - 1)
+        self.assertEqual([], tuples)
+        self.assertIn("(bytes %d > %d): skipped\n" % (len(self.mathml), len(self.mathml) - 1), err)
+
+    def testBytesXml(self):
+        docs = "<html><body>\n<DOCNO>d1</DOCNO>\n<p>" + self.mathml + " and <math><mi>y</mi></math></p>\n</body></html>\n"
+        converted = io.BytesIO()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            parse_xml_file(docid="<DOCNO>", limits={"bytes": len(self.mathml) - 1}, fin=io.BytesIO(docs.encode("utf-8")),
+                           fout=OutputSink(converted), **self.options)
+        self.assertEqual([START_TAG, "#(v!y,!0)#", END_TAG], converted.getvalue().decode("utf-8").split())
+        self.assertIn("query d1, line 1 (bytes %d > %d): skipped\n" % (len(self.mathml), len(self.mathml) - 1), err.getvalue())
+
+    def testCap(self):
+        (full, err) = self.convert()
+        (tuples, err) = self.convert(cap=4)
+        self.assertIn("kept 4 of %d\n" % (len(full) - 2), err)
+        self.assertEqual(4 + 2, len(tuples))
+        remaining = iter(full)
+        self.assertTrue(all(t in remaining for t in tuples))  # in their usual order
+        self.assertFalse(any(t.startswith("#{") for t in tuples))  # symbol pairs before duplicates
+        self.assertEqual(tuples, self.convert(cap=4)[0])
+
+class TestDeadline(TestBase):
+    mathml = ("<math><semantics><mrow><mi>x</mi><mo>+</mo><mi>x</mi></mrow>"
+              "<annotation-xml encoding=\"MathML-Content\"><apply><plus/><ci>x</ci><ci>x</ci></apply></annotation-xml>"
+              "</semantics></math>")
+    options = {"opt": True, "dups": "V", "loc_info": {SYMBOL_PAIR_NODE: 1, TERMINAL_NODE: 1, DUPLICATE_NODE: 1}}
+
+    def testComplete(self):
+        (tuples, skipped) = convert_math_query("test", 1, self.mathml, 10, **self.options)
+        self.assertEqual([], skipped)
+        self.assertEqual(sorted(convert_math_expression("test", 1, self.mathml, **self.options).split()), sorted(tuples.split()))
+
+    def testSkipped(self):
+        (tuples, skipped) = convert_math_query("test", 1, self.mathml, 1e-9, **self.options)
+        self.assertEqual(STAGES[1:], skipped)
+        (pairs, skipped) = convert_math_query("test", 1, self.mathml, 10, **dict(self.options, opt=False, dups="",
+                                                                                loc_info={SYMBOL_PAIR_NODE: 1}))
+        self.assertEqual(pairs, tuples)
+
+    def testTrivialNotCached(self):
+        TRIVIAL_TUPLES.clear()
+        mathml = "<math><msup><mi>x</mi><mn>2</mn></msup></math>"
+        options = {"loc_info": {SYMBOL_PAIR_NODE: 1, TERMINAL_NODE: 1}}
+        (tuples, skipped) = convert_math_query("test", 1, mathml, 1e-9, **options)
+        self.assertEqual(["terminals"], skipped)
+        self.assertNotIn("#(n!2,!0)#", tuples)
+        self.assertIn("#(n!2,!0)#", convert_math_expression("test", 1, mathml, **options))
+        with contextlib.redirect_stderr(io.StringIO()):
+            convert_math_expression("test", 1, mathml, limits={"cap": 1}, **options)
+        self.assertEqual(1, len(TRIVIAL_TUPLES))  # only the complete conversion
+        (tuples, skipped) = convert_math_query("test", 1, mathml, 10, **options)
+        self.assertEqual([], skipped)
+        self.assertIn("#(n!2,!0)#", tuples)
+
+class TestMathSpans(TestBase):
+    def findall(self, content):
+        return [(content[start:end], QName, formula_id) for (start, end, QName, formula_id) in MathExtractor.math_spans(content)]
+
+    def testSameAsPattern(self):
+        for content in ['<p>a <math id="m1"><mi>x</mi></math> b <m:math display="block"><m:mn>2</m:mn></m:math></p>',
+                        '<math><mi>x</mi><math><mi>y</mi></math> <Math alttext="z"><mi>z</mi></Math>',
+                        '<math id="a" id="b"><mi>x</mi></math> <math ><mi>y</mi></math> <math/> <mathematics>',
+                        '<m:math><mi>x</mi></math> <math xml:id=\'q\'>\n<mi>y</mi></math>']:
+            self.assertEqual(MathExtractor.math_pattern.findall(content), self.findall(content))
+
+    def testInContext(self):
+        content = 'a <m:math id="m1"><m:mi>x</m:mi></m:math> b <math><mi>y</mi></math>'
+        self.assertEqual(['a ', '<math id="m1"><mi>x</mi></math>', ' b ', '<math><mi>y</mi></math>', ''],
+                         list(MathExtractor.iter_math_tokens(content, in_context=True)))
+        self.assertEqual(['<math><mi>y</mi></math>'], MathExtractor.math_tokens(content)[1:])
+
+    def testUnclosed(self):
+        content = '<math><mi>x</mi>' * 5000 + '<m:math><mi>y</mi></m:math>'
+        self.assertEqual([('<m:math><mi>y</mi></m:math>', 'm:math', '')], self.findall(content))
+
+    def testLinear(self):
+        # unclosed math elements, each with its own prefix, must not each cost a search of the rest of the document
+        def seconds(n):
+            content = "".join('<a%d:math>' % i for i in range(n)) + '<m:math><mi>y</mi></m:math>'
+            times = []
+            for attempt in range(3):
+                start = time.perf_counter()
+                self.assertEqual(1, len(self.findall(content)))
+                times.append(time.perf_counter() - start)
+            return min(times)
+        self.assertLess(seconds(16000), 24 * seconds(2000))  # 8 times the size: 64 times the time if quadratic
+
+class TestOutputSink(TestBase):
+    def output(self, **kwargs):
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "out")
+            with OutputSink(name, **kwargs) as fout:
+                fout.write("α #(v!x,!0)#\n")
+                fout.write_bytes(b"<p>text</p>")
+                print("done", file=fout)
+                self.assertEqual(len("α #(v!x,!0)#\n<p>text</p>done\n".encode("utf-8")), fout.tell())
+            with open(name, "rb") as fin:
+                return fin.read().decode("utf-8")
+
+    def testBuffered(self):
+        self.assertEqual("α #(v!x,!0)#\n<p>text</p>done\n", self.output())
+        self.assertEqual("α #(v!x,!0)#\n<p>text</p>done\n", self.output(buffer_size=0))
+
+    def testCompressed(self):
+        text = "".join("<p>line %d: <math><mi>x</mi></math></p>\n" % i for i in range(50000))
+        for extension in [".gz", ".bz2", ".xz"]:
+            with tempfile.TemporaryDirectory() as folder:
+                name = os.path.join(folder, "out" + extension)
+                with OutputSink(name, buffer_size=1000) as fout:
+                    fout.write(text)
+                with open_input(name) as fin:
+                    self.assertEqual(text, fin.read().decode("utf-8"))
+
+    def testWritev(self):
+        self.assertEqual("α #(v!x,!0)#\n<p>text</p>done\n", self.output(writev=True))
+        self.assertEqual("α #(v!x,!0)#\n<p>text</p>done\n", self.output(buffer_size=5, writev=True))
+
+class TestCheckpoint(TestBase):
+    def testResume(self):
+        docs = "<DOCNO>d1</DOCNO>\n<p>α <math><mi>x</mi></math></p>\n<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math></p>\n"
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "out")
+            checkpoint = Checkpoint(name + ".checkpoint", "docs", interval=0)
+            with OutputSink(name) as fout:
+                parse_file(fin=io.BytesIO(docs.encode("utf-8")), fout=fout, docid="<DOCNO>", context=True, checkpoint=checkpoint)
+            state = checkpoint.load()
+            self.assertEqual("d2", state["docid"])
+            self.assertEqual(docs.encode("utf-8").index(b"<DOCNO>d2"), state["offset"])
+            with open(name, "rb") as f:
+                output = f.read()
+            self.assertTrue(output[:state["output"]].endswith(b"</p>\n"))
+            with open(name, "r+b") as f:
+                f.truncate(state["output"])
+                f.seek(state["output"])
+                parse_file(fin=io.BytesIO(docs.encode("utf-8")[state["offset"]:]), fout=OutputSink(f), docid="<DOCNO>", context=True)
+            with open(name, "rb") as f:
+                self.assertEqual(output, f.read())
+
+class TestManifest(TestBase):
+    def convert(self, path, docs, **options):
+        manifest = Manifest(path, options)
+        converted = io.BytesIO()
+        parse_documents(manifest, docid="<DOCNO>", fin=io.BytesIO(docs.encode("utf-8")), fout=OutputSink(converted), **options)
+        manifest.close()
+        return (converted.getvalue(), manifest.reused, manifest.converted)
+
+    def testReuse(self):
+        docs = "<DOCNO>d1</DOCNO>\n<p><math><mi>x</mi></math></p>\n<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math></p>\n"
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "manifest")
+            (first, reused, converted) = self.convert(path, docs, context=True)
+            self.assertEqual((0, 2), (reused, converted))
+            self.assertEqual((first, 2, 0), self.convert(path, docs, context=True))
+            (changed, reused, converted) = self.convert(path, docs.replace("<mn>2", "<mn>3"), context=True)
+            self.assertEqual((1, 1), (reused, converted))
+            self.assertNotEqual(first, changed)
+            self.assertEqual((0, 2), self.convert(path, docs)[1:])  # new configuration
+
+class TestSelection(TestBase):
+    def convert(self, **selection):
+        docs = "<DOCNO>d1</DOCNO>\n<p><math><mi>x</mi></math></p>\n<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math></p>\n"
+        converted = io.BytesIO()
+        parse_file(docid="<DOCNO>", context=True, fin=io.BytesIO(docs.encode("utf-8")), fout=OutputSink(converted), **selection)
+        return converted.getvalue().decode("utf-8")
+
+    def testOnly(self):
+        self.assertEqual(self.convert().split("<DOCNO>d2")[0], self.convert(only_docids={"d1"}))
+        self.assertEqual("", self.convert(only_docids={"d3"}))
+
+    def testExclude(self):
+        self.assertEqual("<DOCNO>d2" + self.convert().split("<DOCNO>d2")[1], self.convert(exclude_docids={"d1"}))
+        self.assertEqual("", self.convert(only_docids={"d1"}, exclude_docids={"d1"}))
+
+class TestXmlMode(TestBase):
+    docs = ("<html><body>\n<DOCNO>d1</DOCNO>\n<p>α <math><mi>x</mi><mo>+</mo><mn>1</mn></math> and\n"
+            "<math><msup><mi>y</mi>\n<mn>2</mn></msup></math></p>\n"
+            "<DOCNO>d2</DOCNO>\n<p><math><mfrac><mi>a</mi><mi>b</mi></mfrac></math></p>\n</body></html>\n")
+
+    def convert(self, parse, docs, **options):
+        converted = io.BytesIO()
+        parse(docid="<DOCNO>", loc_info={SYMBOL_PAIR_NODE: 1}, fin=io.BytesIO(docs.encode("utf-8")), fout=OutputSink(converted),
+              **options)
+        return converted.getvalue().decode("utf-8")
+
+    def testSameAsLines(self):
+        self.assertEqual(self.convert(parse_file, self.docs), self.convert(parse_xml_file, self.docs))
+        self.assertEqual(3, self.convert(parse_xml_file, self.docs).count("#(start)#"))
+
+    def testOpt(self):
+        docs = ("<html><body>\n<DOCNO>d1</DOCNO>\n<p><math><semantics><mrow><mi>x</mi><mo>+</mo><mn>1</mn></mrow>"
+                "<annotation-xml encoding=\"MathML-Content\"><apply><plus/><ci>x</ci><cn>1</cn></apply></annotation-xml>"
+                "<annotation encoding=\"application/x-tex\">x+1</annotation></semantics></math></p>\n</body></html>\n")
+        expected = self.convert(parse_file, docs, opt=True)
+        self.assertIn("#(u!plus,v!x,f)#", expected)
+        self.assertIn("#(v!x,+,n)#", expected)
+        self.assertEqual(expected, self.convert(parse_xml_file, docs, opt=True))
+
+    def testDocids(self):
+        elements = MathExtractor.math_elements(io.BytesIO(self.docs.encode("utf-8")), id_tag="DOCNO")
+        self.assertEqual([("d1", 1), ("d1", 2), ("d2", 1)], [(mathID, ordinal) for (mathID, ordinal, elem) in elements])
+
+class TestRecords(TestBase):
+    posts = ('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n'
+             '<row Id="7" PostTypeId="1" Body="&lt;p&gt;&lt;math&gt;&lt;mi&gt;x&lt;/mi&gt;&lt;/math&gt;&lt;/p&gt;" />\n'
+             '<row Id="9" PostTypeId="2" Body="no math" />\n'
+             '<row Id="12" PostTypeId="2" Body="&lt;math&gt;&lt;mn&gt;2&lt;/mn&gt;&lt;/math&gt;" />\n</posts>\n')
+
+    def convert(self, **options):
+        converted = io.BytesIO()
+        parse_records_file("row", fin=io.BytesIO(self.posts.encode("utf-8")), fout=OutputSink(converted), **options)
+        return converted.getvalue().decode("utf-8")
+
+    def testRecords(self):
+        self.assertEqual([("7", "<p><math><mi>x</mi></math></p>"), ("9", "no math"), ("12", "<math><mn>2</mn></math>")],
+                         list(MathExtractor.records(io.BytesIO(self.posts.encode("utf-8")), "row")))
+
+    def testDocids(self):
+        self.assertEqual("<DOCNO>7\n<p>#(start)# #(v!x,!0)# #(end)#</p>\n<DOCNO>9\nno math\n<DOCNO>12\n#(start)# #(n!2,!0)# #(end)#\n",
+                         self.convert(docid="<DOCNO>", context=True))
+        self.assertEqual("#(start)# #(n!2,!0)# #(end)#\n", self.convert(only_docids={"12"}))
+        self.assertEqual("#(start)# #(v!x,!0)# #(end)#\n", self.convert(exclude_docids={"12"}))
+
+class TestMappedFile(TestBase):
+    def convert(self, parse, name, **options):
+        converted = io.BytesIO()
+        with open(name, "rb") as fin:
+            parse(docid="<DOCNO>", loc_info={SYMBOL_PAIR_NODE: 1}, fin=fin, fout=OutputSink(converted), **options)
+        return converted.getvalue()
+
+    def testSameAsLines(self):
+        docs = ("<DOCNO>d1</DOCNO>\n<p>é <m:math><m:mi>x</m:mi><m:mo>=</m:mo><m:mn>1</m:mn></m:math> and\r\n"
+                "<math><msup><mi>y</mi>\n<mn>2</mn></msup></math> text</p>\n"
+                "<DOCNO>d2</DOCNO>\n<p><math><mfrac><mi>a</mi><mi>b</mi></mfrac></math> ∑ <math><mi>z</mi></math></p>")
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "docs")
+            with open(name, "wb") as f:
+                f.write(docs.encode("utf-8"))
+            for context in [True, False]:
+                self.assertEqual(self.convert(parse_file, name, context=context),
+                                 self.convert(parse_mapped_file, name, context=context))
+            self.assertEqual(4, self.convert(parse_mapped_file, name).count(b"#(start)#"))
+            open(name, "wb").close()
+            self.assertEqual(b"", self.convert(parse_mapped_file, name, context=True))
+
+class TestUnterminated(TestBase):
+    docs = ("<DOCNO>d1</DOCNO>\n<p><math><mi>x</mi>\n" + "<p>text</p>\n" * 10 +
+            "<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math></p>\n")
+
+    def convert(self, docs, **options):
+        converted = io.BytesIO()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            parse_file(docid="<DOCNO>", fin=io.BytesIO(docs.encode("utf-8")), fout=OutputSink(converted), **options)
+        return (converted.getvalue().decode("utf-8"), err.getvalue())
+
+    def testAbandoned(self):
+        for limits in [{"max_math_lines": 5}, {"max_math_bytes": 40, "max_math_lines": 0}]:
+            (output, err) = self.convert(self.docs, **limits)
+            self.assertEqual("#(error)# #(start)# #(n!2,!0)# #(end)#\n", output)
+            self.assertEqual(1, err.count("Unterminated math expression in data file or query d1,"))
+            (output, err) = self.convert(self.docs, context=True, **limits)
+            self.assertEqual(1, output.count("#(error)#"))
+            self.assertTrue(output.endswith("<DOCNO>d2</DOCNO>\n<p>#(start)# #(n!2,!0)# #(end)#</p>\n"))
+
+    def testEndOfFile(self):
+        (output, err) = self.convert("<DOCNO>d1</DOCNO>\n<p><math><mn>1</mn></math>\n<math><mi>x</mi>\n</p>\n")
+        self.assertEqual("#(start)# #(n!1,!0)# #(end)#\n#(error)# ", output)
+        self.assertEqual(1, err.count("Unterminated math expression"))
+
+    def testSkippedDocument(self):
+        docs = self.docs + "<DOCNO>d3</DOCNO>\n<p><math><mi>z</mi></math></p>\n"
+        (output, err) = self.convert(docs, exclude_docids={"d2"})
+        self.assertEqual("#(error)# #(start)# #(v!z,!0)# #(end)#\n", output)
+        self.assertIn("Unterminated math expression in data file or query d1, line 11:", err)
+        self.assertNotIn("query d2", err)
+
+class TestFormulaIndex(TestBase):
+    def testFetch(self):
+        docs = "<DOCNO>d1</DOCNO>\n<p>é <m:math><m:mi>x</m:mi></m:math> and\n<math><mi>y</mi>\n</math></p>\n<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math></p>\n"
+        with tempfile.TemporaryDirectory() as folder:
+            infile = os.path.join(folder, "docs")
+            with open(infile, "wb") as f:
+                f.write(docs.encode("utf-8"))
+            index = FormulaIndex(os.path.join(folder, "index"), infile=infile)
+            converted = io.BytesIO()
+            with open(infile, "rb") as fin:
+                parse_file(docid="<DOCNO>", fin=fin, fout=OutputSink(converted), index=index)
+            self.assertEqual('<m:math><m:mi>x</m:mi></m:math>', index.fetch("d1", 1))
+            self.assertEqual('<math><mi>y</mi>\n</math>', index.fetch("d1", 2))
+            self.assertEqual(docs[docs.index("<DOCNO>d2"):], index.fetch("d2"))
+            self.assertEqual(converted.getvalue().decode("utf-8").split("\n")[:3],
+                             [convert_indexed_formula(index, docid, ordinal) for (docid, ordinal) in [("d1", 1), ("d1", 2), ("d2", 1)]])
+            self.assertIsNone(index.locate("d2", 2))
+            index.close()
+
+class TestFormulaSpans(TestBase):
+    def testSpans(self):
+        docs = "<DOCNO>d1</DOCNO>\n<p>é <m:math><m:mi>x</m:mi></m:math></p>\n<DOCNO>d2</DOCNO>\n<p><math><mn>2</mn></math>\n</p>\n"
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, "spans")
+            spans = FormulaSpans(name)
+            converted = io.BytesIO()
+            parse_file(docid="<DOCNO>", context=True, fin=io.BytesIO(docs.encode("utf-8")), fout=OutputSink(converted), spans=spans)
+            spans.close()
+            with open(name, encoding="utf-8") as f:
+                rows = [line.rstrip("\n").split("\t") for line in f][1:]
+        output = converted.getvalue().decode("utf-8")
+        self.assertEqual(["d1", "1"], rows[0][:2])
+        self.assertEqual(["d2", "1"], rows[1][:2])
+        for (row, start) in zip(rows, [0, docs.index("<DOCNO>d2")]):
+            (char_start, char_end, byte_start, byte_end) = [int(n) for n in row[2:6]]
+            self.assertTrue(docs[start + char_start:start + char_end].endswith("ath>"))
+            self.assertEqual(len(docs[start:start + char_start].encode("utf-8")), byte_start)
+        (char_start, char_end) = [int(n) for n in rows[0][6:8]]
+        self.assertEqual(output[char_start:char_end], convert_test('<math><mi>x</mi></math>'))
+        (char_start, char_end) = [int(n) for n in rows[1][6:8]]
+        self.assertEqual(output[output.index("<DOCNO>d2"):][char_start:char_end], convert_test('<math><mn>2</mn></math>'))
+
+class TestShards(TestBase):
+    def testRanges(self):
+        docs = "".join("<DOCNO>d%d</DOCNO>\n<p><math><mi>x</mi></math>\n</p>\n" % i for i in range(10)).encode("utf-8")
+        with tempfile.TemporaryDirectory() as folder:
+            infile = os.path.join(folder, "docs")
+            with open(infile, "wb") as f:
+                f.write(docs)
+            ranges = shard_ranges(infile, 3)
+            self.assertEqual(3, len(ranges))
+            self.assertEqual((0, len(docs)), (ranges[0][0], ranges[-1][1]))
+            for ((start, end), (next_start, next_end)) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+                self.assertTrue(docs[next_start:].startswith(b"<DOCNO>"))
+            self.assertEqual(10, len(shard_ranges(infile, 20)))  # at most one shard per document
+
+    def testRun(self):
+        docs = "".join("<DOCNO>d%d</DOCNO>\n<p><math><mi>x</mi><mo>+</mo><mn>%d</mn></math>\n</p>\n" % (i, i)
+                       for i in range(12))
+        with tempfile.TemporaryDirectory() as folder:
+            infile = os.path.join(folder, "docs")
+            with open(infile, "w") as f:
+                f.write(docs)
+            whole = os.path.join(folder, "whole")
+            subprocess.check_call([sys.executable, "-m", "mathtuples.convert", "-infile", infile, "-outfile", whole,
+                                   "-docid", "<DOCNO>"])
+            with open(whole, "rb") as f:
+                expected = f.read()
+            outdir = os.path.join(folder, "shards")
+            run = ShardRun(outdir)
+            shards = run.plan(infile, 3, suffix=".gz")["shards"]
+            self.assertEqual(3, len(shards))
+            # the launcher fails shard 1, whose output is then missing until it is retried
+            self.assertFalse(run.run(jobs=3, launcher="test {shard} != 1 && {command}"))
+            self.assertEqual(["done", "failed", "done"], [shard["status"] for shard in run.manifest["shards"]])
+            self.assertRaises(ValueError, run.merge, os.path.join(folder, "merged.gz"))
+            retry = ShardRun(outdir)
+            retry.load()
+            self.assertTrue(retry.run())
+            self.assertEqual([1, 2, 1], [shard["attempts"] for shard in retry.manifest["shards"]])
+            self.assertEqual(["manifest.json"] + ["shard-%05d.gz%s" % (i, log) for i in range(3) for log in ["", ".log"]],
+                             sorted(os.listdir(outdir)))  # no partial outputs left behind
+            retry.merge(os.path.join(folder, "merged.gz"))
+            with gzip.open(os.path.join(folder, "merged.gz"), "rb") as f:
+                self.assertEqual(expected, f.read())
+
+def exit_once(item, marker):
+    # the first worker given "exit" dies during the task
+    if item == "exit" and not os.path.exists(marker):
+        open(marker, "w").close()
+        time.sleep(0.2)
+        os._exit(1)
+    return item.upper()
+
+class TestWorkerPool(TestBase):
+    def testBatches(self):
+        pool = WorkerPool(convert_formula, {}, cost=len, batch_cost=10)
+        self.assertEqual([["ab", "cd", "efghij"], ["k" * 12], ["lmnopqrst", "uv"], ["w"]],
+                         list(pool.batches(["ab", "cd", "efghij", "k" * 12, "lmnopqrst", "uv", "w"])))
+
+    def testOrder(self):
+        records = [("f%d" % i, "<math><mi>x</mi>" + "<mo>+</mo><mn>1</mn>" * i + "</math>") for i in range(40)]
+        expected = [convert_formula(record, {}) for record in records]
+        with WorkerPool(convert_formula, {}, workers=3, cost=formula_cost, batch_cost=500) as pool:
+            self.assertEqual(expected, list(pool.imap(records)))
+            self.assertEqual(40, sum(count for (batches, count, busy, fraction) in pool.utilization().values()))
+
+    def testRecycling(self):
+        items = ["a", "b", "exit", "c", "d", "e", "f"]
+        with tempfile.TemporaryDirectory() as folder:
+            pool = RecyclingPool(2, exit_once, os.path.join(folder, "marker"), max_tasks=2)
+            self.assertEqual([item.upper() for item in items], list(pool.imap(run_task, items)))
+            pool.close()
+            pool.join()
+            self.assertGreaterEqual(pool.retired, 3)
+
+    def testEarlyFailure(self):
+        items = ["exit"] + [chr(ord("a") + i) for i in range(20)]  # more than 4 tasks per worker wait for the first
+        with tempfile.TemporaryDirectory() as folder:
+            pool = RecyclingPool(2, exit_once, os.path.join(folder, "marker"), max_tasks=100)
+            self.assertEqual([item.upper() for item in items], list(pool.imap(run_task, items)))
+            pool.close()
+            pool.join()
+            self.assertEqual(1, pool.retired)
+
+    def testLineSpans(self):
+        data = b"ab\ncd\nefghijklmnop\nq\nr"
+        self.assertEqual([(0, 6), (6, 13), (19, 3)], list(line_spans(data, 0, 8)))
+        self.assertEqual([(3, 3), (6, 13), (19, 3)], list(line_spans(data, 3, 8)))
+
+    def testShared(self):
+        rows = "".join("f%d\t<math><mi>x</mi>%s</math>\n" % (i, "<mo>+</mo><mn>1</mn>" * i) for i in range(30))
+        with tempfile.TemporaryDirectory() as folder:
+            infile = os.path.join(folder, "formulas.tsv")
+            with open(infile, "w", encoding="utf-8", newline="") as f:
+                f.write("id\tformula\n" + rows)
+            expected = io.BytesIO()
+            with open(infile, "rb") as fin:
+                parse_formula_file("tsv", fin=fin, fout=OutputSink(expected))
+            out = io.BytesIO()
+            parse_shared_formula_file("tsv", infile, workers=2, batch_cost=100, fout=OutputSink(out))
+            self.assertEqual(expected.getvalue(), out.getvalue())
+
+class TestFormulaFile(TestBase):
+    jsonl = ('{"id": "f1", "formula": "<math><mi>x</mi></math>"}\nnot json\n\n{"id": "f4"}\n[5]\n'
+             '{"id": "f6", "formula": "x^2"}\n{"id": "f7", "formula": "\\\\frac12"}\n')
+
+    def convert(self, file_format, data, **options):
+        converted = io.BytesIO()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            parse_formula_file(file_format, fin=io.BytesIO(data.encode("utf-8")), fout=OutputSink(converted), **options)
+        return (converted.getvalue().decode("utf-8").splitlines(), err.getvalue())
+
+    def testBadRows(self):
+        (lines, err) = self.convert("jsonl", self.jsonl)
+        self.assertEqual(["f1", "line 2", "line 4", "line 5", "f6", "f7"], [line.split("\t")[0] for line in lines])
+        self.assertEqual(["line 2\t#(error)#", "line 4\t#(error)#", "line 5\t#(error)#"], lines[1:4])
+        self.assertIn("formula file, line 4", err)
+        (lines, err) = self.convert("tsv", "id\tformula\nf1\t<math><mi>x</mi></math>\nf2\n\nf3\tx_1\n")
+        self.assertEqual(["f1", "line 3", "f3"], [line.split("\t")[0] for line in lines])
+        self.assertRaisesRegex(ValueError, "no column named latex", self.convert, "tsv", "id\tformula\n", math_field="latex")
+
+    def testReport(self):
+        (lines, err) = self.convert("jsonl", self.jsonl)
+        self.assertIn("LaTeX formulas converted: 2 natively, 0 by LaTeXML", err)
+        self.assertEqual((lines, err), self.convert("jsonl", self.jsonl, workers=2, batch_cost=0))
+        with tempfile.TemporaryDirectory() as folder:
+            infile = os.path.join(folder, "formulas.jsonl")
+            with open(infile, "w", encoding="utf-8") as f:
+                f.write(self.jsonl)
+            out = io.BytesIO()
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                parse_shared_formula_file("jsonl", infile, workers=2, batch_cost=60, fout=OutputSink(out))
+            self.assertEqual(lines, out.getvalue().decode("utf-8").splitlines())
+            self.assertIn("LaTeX formulas converted: 2 natively, 0 by LaTeXML", err.getvalue())
+
+    def testLaTeXML(self):
+        # formulas LatexToSLT cannot parse cost 220 each, so three make a batch, converted by one latexmlc run
+        jsonl = "".join('{"id": "f%d", "formula": "\\\\foo_%d"}\n' % (i, i) for i in range(6))
+        jsonl += '{"id": "f6", "formula": "x^2"}\n'
+        latexml = FakeLatexML()
+        with mock.patch.object(LatexToMathML, "stylesheet", return_value="mws.sty.ltxml"),\
+             mock.patch.object(LatexToMathML, "cache", None),\
+             mock.patch("subprocess.run", side_effect=latexml),\
+             mock.patch("subprocess.Popen", side_effect=AssertionError("latexmlmath was run")):
+            (lines, err) = self.convert("jsonl", jsonl, batch_cost=660)
+        self.assertEqual([["\\foo_0", "\\foo_1", "\\foo_2"], ["\\foo_3", "\\foo_4", "\\foo_5"]], latexml.batches)
+        self.assertEqual(["f%d" % i for i in range(7)], [line.split("\t")[0] for line in lines])
+        self.assertNotIn("#(error)#", "".join(lines))
+        self.assertIn("LaTeX formulas converted: 1 natively, 6 by LaTeXML", err)
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
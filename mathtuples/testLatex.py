@@ -0,0 +1,165 @@
+"""
+    mathtuples
+    Tests for converting LaTeX to symbol layout trees without LaTeXML, and for batching and caching LaTeXML's conversions
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from .latex_slt import LatexToSLT
+from .latex_mml import LatexCache, LatexToMathML, LatexMLPool
+from .exceptions import UnsupportedLatexException
+
+
+class TestLatexToSLT(unittest.TestCase):
+    def check(self, tex, expect):
+        self.assertEqual(expect, LatexToSLT.tree_from_latex(tex, fallback=False).toString())
+
+    def testScripts(self):
+        self.check(r"y_i^n = n + x^n",
+                   "-(V!y:b(V!i:),a(V!n:),n(=:n(V!n:n(+:n(V!x:a(V!n:))))))")
+        self.check(r"\sum_{i=1}^{n} i",
+                   "-(∑:u(V!i:n(=:n(N!1:))),o(V!n:),n(V!i:))")
+
+    def testFractionsAndRoots(self):
+        self.check(r"\frac12", "-(F!:o(N!1:),u(N!2:))")
+        self.check(r"\sqrt[3]{x+1}", "-(R!:w(V!x:n(+:n(N!1:))),c(N!3:))")
+
+    def testFences(self):
+        self.check(r"\left( a+b \right)^2", "-(M!()1x1:w(V!a:n(+:n(V!b:))),a(N!2:))")
+        self.check(r"f(a,b)", "-(V!f:n(M!()1x2:w(V!a:e(V!b:))))")
+
+    def testMatrix(self):
+        self.check(r"\begin{matrix} a & b \\ c & d \end{matrix}",
+                   "-(M!2x2:w(V!a:e(V!b:e(V!c:e(V!d:)))))")
+
+    def testWildcard(self):
+        self.check(r"\qvar{A} + 1", "-(?A:n(+:n(N!1:)))")
+
+    def testUnsupported(self):
+        for tex in [r"\foo x", r"|x|", r"(a", r"\begin{cases} a \end{cases}"]:
+            with self.assertRaises(UnsupportedLatexException):
+                LatexToSLT.tree_from_latex(tex, fallback=False)
+
+
+class TestLatexCache(unittest.TestCase):
+    def testEviction(self):
+        cache = LatexCache(capacity=2)
+        cache.put("a", "<math>a</math>")
+        cache.put("b", "<math>b</math>")
+        self.assertEqual("<math>a</math>", cache.get("a"))  # a is now the most recently used
+        cache.put("c", "<math>c</math>")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(["a", "c"], list(cache.memory))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def testPersistence(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "latex.db")
+            cache = LatexCache(capacity=1, path=path)
+            cache.put("a", "<math>a</math>")
+            cache.put("b", "<math>b</math>")
+            self.assertEqual("<math>a</math>", cache.get("a"))  # evicted from memory, but still on disk
+            cache.close()
+            cache = LatexCache(path=path)
+            self.assertEqual(["<math>a</math>", "<math>b</math>", None], [cache.get(key) for key in ["a", "b", "c"]])
+            cache.close()
+
+    def testForked(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = LatexCache(path=os.path.join(folder, "latex.db"))
+            cache.put("a", "<math>a</math>")
+            process = multiprocessing.get_context("fork").Process(target=put_in_child, args=(cache, cache.db))
+            process.start()
+            process.join()
+            self.assertEqual(0, process.exitcode)
+            self.assertEqual(["<math>a</math>", "<math>b</math>"], [cache.get(key) for key in ["a", "b"]])
+            cache.close()
+
+    def testKey(self):
+        self.assertEqual(LatexCache.key(" x^2 ", ["amsmath"]), LatexCache.key("x^2", ["amsmath"]))
+        self.assertNotEqual(LatexCache.key("x^2", ["amsmath"]), LatexCache.key("x^2", ["amsmath", "amsfonts"]))
+        with mock.patch.object(LatexToMathML, "stylesheet", return_value="mws.sty.ltxml"):
+            key = LatexToMathML.cache_key("x^2")
+            with mock.patch.object(LatexToMathML, "preloads", ["amsmath"]):
+                self.assertNotEqual(key, LatexToMathML.cache_key("x^2"))
+
+    def testConversionSkipped(self):
+        with mock.patch.object(LatexToMathML, "stylesheet", return_value="mws.sty.ltxml"),\
+             mock.patch.object(LatexToMathML, "cache", LatexCache()),\
+             mock.patch("subprocess.Popen", side_effect=AssertionError("latexmlmath was run")):
+            LatexToMathML.cache.put(LatexToMathML.cache_key("x^2"), "<math>cached</math>")
+            self.assertEqual("<math>cached</math>", LatexToMathML.convert_to_mathml("x^2"))
+
+
+def put_in_child(cache, inherited):
+    cache.put("b", "<math>b</math>")
+    sys.exit(1 if cache.db is inherited else 0)  # the parent's connection must not be used
+
+class FakeLatexML(object):
+    """
+    stands in for subprocess.run of latexmlc, typesetting each $tex$ of the source as <math><mi>tex</mi></math>,
+    except for formulas listed in drop
+    """
+    def __init__(self, drop=()):
+        self.drop = drop
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, cmd, **kwargs):
+        destination = [arg for arg in cmd if arg.startswith("--destination=")][0][len("--destination="):]
+        with open(cmd[-1], encoding="utf-8") as f:
+            formulas = re.findall(r"\$(.*?)\$", f.read())
+        with self.lock:
+            self.batches.append(formulas)
+        with open(destination, "w", encoding="utf-8") as f:
+            f.write("".join("<p><math><mi>%s</mi></math></p>\n" % tex for tex in formulas if tex not in self.drop))
+        return subprocess.CompletedProcess(cmd, 0, b"", b"")
+
+class TestLatexMLPool(unittest.TestCase):
+    def setUp(self):
+        patches = [mock.patch.object(LatexToMathML, "stylesheet", return_value="mws.sty.ltxml"),
+                   mock.patch.object(LatexToMathML, "cache", None),
+                   mock.patch.object(LatexToMathML, "convert_to_mathml", side_effect=lambda tex: "<math>" + tex + "</math>")]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def convert(self, tex_queries, latexml, **options):
+        with mock.patch("subprocess.run", side_effect=latexml), LatexMLPool(**options) as pool:
+            return pool.convert_all(tex_queries)
+
+    def testBatches(self):
+        latexml = FakeLatexML()
+        tex_queries = ["x_%d" % i for i in range(7)]
+        results = self.convert(tex_queries, latexml, workers=3, batch_size=3)
+        self.assertEqual(["<math><mi>%s</mi></math>" % tex for tex in tex_queries], results)
+        self.assertEqual([tex_queries[0:3], tex_queries[3:6], tex_queries[6:]], sorted(latexml.batches))
+        self.assertFalse(LatexToMathML.convert_to_mathml.called)
+
+    def testFallback(self):
+        latexml = FakeLatexML(drop=["x_4"])
+        tex_queries = ["x_%d" % i for i in range(6)]
+        results = self.convert(tex_queries, latexml, workers=1, batch_size=3)
+        self.assertEqual(["<math><mi>x_0</mi></math>", "<math><mi>x_1</mi></math>", "<math><mi>x_2</mi></math>",
+                          "<math>x_3</math>", "<math>x_4</math>", "<math>x_5</math>"], results)
+        self.assertEqual(["x_3", "x_4", "x_5"], [call.args[0] for call in LatexToMathML.convert_to_mathml.call_args_list])
+
+    def testCached(self):
+        latexml = FakeLatexML()
+        with mock.patch.object(LatexToMathML, "cache", LatexCache()):
+            self.assertEqual(self.convert(["a", "b"], latexml), self.convert(["b", "a", "c"], latexml)[1::-1])
+        self.assertEqual([["a", "b"], ["c"]], latexml.batches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,334 @@
+"""
+    mathtuples
+    Pool of worker processes for converting formulas in parallel
+
+    This file is distributed with mathtuples under the terms of the
+    GNU General Public License, version 3 or later (see GNU LICENSE.txt).
+
+    Packaged with mathtuples. Contact:
+        - Frank Tompa, fwtompa@uwaterloo.ca
+"""
+import collections
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import tempfile
+import threading
+import time
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+__author__ = 'FWTompa'
+
+BATCH_COST = 20000  # estimated cost of the work sent to a worker at a time (when costs are estimated)
+WATCH_INTERVAL = 1.0  # seconds between checks of a busy worker's memory
+ATTEMPTS = 3  # workers that may fail on the same task before giving up
+
+# set in each worker process by init_worker
+worker_function = None
+worker_options = None
+worker_prepare = None
+
+def init_worker(function, options, prepare=None):
+    global worker_function, worker_options, worker_prepare
+    worker_function = function
+    worker_options = options
+    worker_prepare = prepare
+
+# input files memory-mapped by mapped_input, once in each process
+mapped_inputs = {}
+
+def mapped_input(path):
+    """
+    return: the file, memory-mapped read-only, so that processes share its pages rather than copies of its contents
+    rtype:  mmap.mmap
+    """
+    if path not in mapped_inputs:
+        with open(path, "rb") as f:
+            mapped_inputs[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped_inputs[path]
+
+def shared_directory():
+    """
+    return: a new directory in shared memory (/dev/shm) if there is one, else in the temporary directory
+    rtype:  str
+    """
+    return tempfile.mkdtemp(prefix="mathtuples-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+def run_task(item):
+    return worker_function(item, worker_options)
+
+def run_batch(batch):
+    start = time.perf_counter()
+    if worker_prepare is not None:
+        batch = worker_prepare(batch, worker_options)
+    results = [worker_function(item, worker_options) for item in batch]
+    return (os.getpid(), time.perf_counter() - start, results)
+
+def resident_bytes():
+    """
+    return: the resident set size of this process (its peak, where /proc is not available)
+    rtype:  int
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except OSError:
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # macOS reports bytes, others KiB
+
+def recycling_worker(conn, function, options, max_rss, max_tasks, prepare=None):
+    """
+    Run the tasks received on conn until told to stop (None), or until past max_rss bytes or max_tasks tasks;
+    a worker past max_rss in the middle of a task (other than its first) exits at once, leaving the task to another
+    """
+    init_worker(function, options, prepare)
+    tasks = 0
+    busy = threading.Event()
+    if max_rss:
+        def watch():
+            while True:
+                time.sleep(WATCH_INTERVAL)
+                if busy.is_set() and tasks > 0 and resident_bytes() > max_rss:
+                    os._exit(1)
+        threading.Thread(target=watch, daemon=True).start()
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        (index, run, chunk) = task
+        busy.set()
+        try:
+            result = (index, True, [run(item) for item in chunk])
+        except Exception as err:
+            result = (index, False, err)
+        busy.clear()
+        tasks += 1
+        retire = (max_tasks and tasks >= max_tasks) or (max_rss and resident_bytes() > max_rss)
+        conn.send(result + (bool(retire),))
+        if retire:
+            break
+    conn.close()
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class RecyclingPool(object):
+    """
+    A pool of worker processes, each replaced by a fresh one once it has run max_tasks tasks or its resident memory
+    is past max_rss bytes (0 => no limit).  A worker that dies during a task, whether it stopped itself for using
+    too much memory or was killed, is replaced and its task sent to another worker.
+    """
+    def __init__(self, workers, function, options, max_rss=0, max_tasks=0, prepare=None):
+        self.function = function
+        self.options = options
+        self.prepare = prepare
+        self.max_rss = max_rss
+        self.max_tasks = max_tasks
+        self.retired = 0  # workers replaced
+        self.workers = [self.start() for i in range(workers)]
+
+    def start(self):
+        (conn, child) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=recycling_worker, daemon=True,
+                                          args=(child, self.function, self.options, self.max_rss, self.max_tasks, self.prepare))
+        process.start()
+        child.close()
+        return [process, conn, None]  # the task in progress, if any
+
+    def replace(self, worker):
+        (process, conn, task) = worker
+        conn.close()
+        process.join()
+        self.retired += 1
+        worker[:] = self.start()
+
+    def imap(self, run, items, chunksize=1):
+        """
+        return: run applied to each item, in order, as for multiprocessing.Pool.imap
+        rtype:  iterator
+        """
+        tasks = ((index, run, chunk) for (index, chunk) in enumerate(chunks(items, chunksize)))
+        failures = collections.Counter()
+        results = {}
+        next_index = 0
+        exhausted = False
+        while True:
+            for worker in self.workers:
+                # keep the results waiting for an earlier task (always in progress) bounded
+                if worker[2] is None and not exhausted and len(results) < 4 * len(self.workers):
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    worker[1].send(task)
+                    worker[2] = task
+            busy = [worker for worker in self.workers if worker[2] is not None]
+            if not busy:
+                break
+            for conn in multiprocessing.connection.wait([worker[1] for worker in busy]):
+                worker = next(worker for worker in busy if worker[1] is conn)
+                try:
+                    (index, ok, value, retire) = conn.recv()
+                except EOFError:
+                    task = worker[2]
+                    failures[task[0]] += 1
+                    if failures[task[0]] >= ATTEMPTS:
+                        raise RuntimeError("task %d failed in %d workers" % (task[0], ATTEMPTS))
+                    # a fresh worker is not stopped during its first task, so the task can finish there
+                    self.replace(worker)
+                    worker[1].send(task)
+                    worker[2] = task
+                    continue
+                if not ok:
+                    raise value
+                worker[2] = None
+                results[index] = value
+                if retire:
+                    self.replace(worker)
+            while next_index in results:
+                for result in results.pop(next_index):
+                    yield result
+                next_index += 1
+        if results or not exhausted:
+            raise RuntimeError("results of %d tasks were not returned" % (len(results) + 1))
+
+    def close(self):
+        for (process, conn, task) in self.workers:
+            if task is None:
+                conn.send(None)
+            else:  # abandoned with its result unread
+                process.terminate()
+            conn.close()
+
+    def join(self):
+        for (process, conn, task) in self.workers:
+            process.join()
+        self.workers = []
+
+
+class WorkerPool(object):
+    """
+    Apply function(item, options) to a stream of items, in order, using several processes
+
+    function must be defined at the top level of a module (so that it can be sent to the workers);
+    with a single worker, everything is done in the current process.
+
+    If cost(item) estimates the work for an item, items are sent to the workers in batches of about batch_cost:
+    an item costing that much or more is a batch by itself, and small items are grouped together.
+    Idle workers take the next batch from the pool's shared queue, so none waits behind another's long batch,
+    and the time each worker spends busy is recorded for utilization().
+    If prepare(batch, options) is given, it is applied to each batch in the worker before function is applied to
+    the items it returns, so that work shared by a batch's items (e.g., starting LaTeXML) is done once per batch.
+
+    With max_rss (bytes) or max_tasks, workers are replaced by fresh processes as they reach either limit (see
+    RecyclingPool), even with a single worker.
+    """
+    def __init__(self, function, options, workers=1, chunksize=64, cost=None, batch_cost=BATCH_COST,
+                 max_rss=0, max_tasks=0, prepare=None):
+        self.function = function
+        self.options = options
+        self.prepare = prepare
+        self.workers = max(1, workers)
+        self.chunksize = chunksize
+        self.cost = cost
+        self.batch_cost = batch_cost
+        self.busy = {}  # batches, items, and seconds busy for each worker process
+        self.started = None
+        self.pool = None
+        if max_rss or max_tasks:
+            self.pool = RecyclingPool(self.workers, function, options, max_rss=max_rss, max_tasks=max_tasks,
+                                      prepare=prepare)
+        elif self.workers > 1:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_worker,
+                                             initargs=(function, options, prepare))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def imap(self, items):
+        """
+        return: function applied to each item, in the order of items
+        rtype:  iterator
+        """
+        if self.cost is not None:
+            return self.imap_batches(items)
+        if self.pool is None:
+            return (self.function(item, self.options) for item in items)
+        return self.pool.imap(run_task, items, self.chunksize)
+
+    def batches(self, items):
+        """
+        return: items grouped into batches of about batch_cost, each expensive item alone
+        rtype:  iterator of lists
+        """
+        batch = []
+        total = 0
+        for item in items:
+            cost = self.cost(item)
+            if cost >= self.batch_cost:
+                if batch:
+                    yield batch
+                    batch = []
+                    total = 0
+                yield [item]
+                continue
+            batch.append(item)
+            total += cost
+            if total >= self.batch_cost:
+                yield batch
+                batch = []
+                total = 0
+        if batch:
+            yield batch
+
+    def imap_batches(self, items):
+        self.started = time.perf_counter()
+        if self.pool is None:
+            init_worker(self.function, self.options, self.prepare)
+            results = (run_batch(batch) for batch in self.batches(items))
+        else:
+            results = self.pool.imap(run_batch, self.batches(items), 1)
+        for (pid, seconds, batch_results) in results:
+            (batches, count, busy) = self.busy.get(pid, (0, 0, 0.0))
+            self.busy[pid] = (batches + 1, count + len(batch_results), busy + seconds)
+            for result in batch_results:
+                yield result
+
+    def utilization(self):
+        """
+        return: for each worker process, the batches and items it converted, its seconds busy, and the fraction of
+                the elapsed time that it was busy
+        rtype:  dict of pid: (int, int, float, float)
+        """
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {pid: (batches, count, busy, busy / elapsed if elapsed else 0.0)
+                for (pid, (batches, count, busy)) in sorted(self.busy.items())}
+
+    def report(self, file=sys.stderr):
+        for (pid, (batches, count, busy, fraction)) in self.utilization().items():
+            print("worker %d: %d batches, %d items, %.2fs busy (%.0f%%)" % (pid, batches, count, busy, 100 * fraction), file=file)
+        if isinstance(self.pool, RecyclingPool):
+            print("%d workers replaced" % self.pool.retired, file=file)